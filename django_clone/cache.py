@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+
+
+class GraphSnapshot(object):
+    """
+    discovered objects of a clone, kept as rows of plain field values
+    keys are the (key model, value) pairs that foreign keys can use to refer
+    to the objects, and expanded_keys are the keys of the objects whose
+    relations were followed, which new references can add objects to
+    """
+
+    def __init__(self, objs, keys, expanded_keys):
+        self.models = []
+        self.rows = []
+        self.keys = frozenset(keys)
+        self.expanded_keys = frozenset(expanded_keys)
+        indexes = {}
+        for obj in objs:
+            model = obj.__class__
+            if model not in indexes:
+                indexes[model] = len(self.models)
+                self.models.append(model)
+            self.rows.append((indexes[model], tuple(getattr(obj, field.attname)
+                                                    for field in model._meta.concrete_fields)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_objects(self, using):
+        """
+        new instances of the discovered objects, as if they were loaded from using
+        """
+        field_names = [[field.attname for field in model._meta.concrete_fields] for model in self.models]
+        return [self.models[index].from_db(using, field_names[index], values) for index, values in self.rows]
+
+
+class DiscoveryCache(object):
+    """
+    least recently used snapshots of discovered graphs, keyed by their roots
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._snapshots = OrderedDict()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, key):
+        return key in self._snapshots
+
+    def get(self, key):
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move it to the end, the least recently used snapshot is the first one.
+        del self._snapshots[key]
+        self._snapshots[key] = snapshot
+        return snapshot
+
+    def set(self, key, snapshot):
+        self._snapshots.pop(key, None)
+        self._snapshots[key] = snapshot
+        while len(self._snapshots) > self.max_size:
+            self._snapshots.popitem(last=False)
+
+    def invalidate(self, keys=(), references=()):
+        """
+        drop the snapshots that contain an object of keys, or
+        whose expanded objects are referred to by references
+        """
+        keys = set(key for key in keys if key is not None)
+        references = set(key for key in references if key is not None)
+        for root_key, snapshot in list(self._snapshots.items()):
+            if not snapshot.keys.isdisjoint(keys) or not snapshot.expanded_keys.isdisjoint(references):
+                del self._snapshots[root_key]
+
+    def clear(self):
+        self._snapshots.clear()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+
+from django.apps import apps
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class Checkpoint(object):
+    """
+    progress of a resumable clone, kept in a file as a log of JSON lines
+    the first line describes the clone and every other line is a step that
+    was finished, a step is written just before its transaction commits,
+    so the last step of an interrupted clone has to be checked
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.steps = []
+
+    def load(self):
+        """
+        read the log of an earlier run, returns whether there was one
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            lines = f.read().split("\n")
+        records = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # The last line is cut off when the process dies while writing it.
+                break
+        if not records:
+            return False
+        self.header, self.steps = records[0], records[1:]
+        self._write()
+        return True
+
+    def start(self, header):
+        """
+        begin a new log
+        """
+        self.header = self.encode(header)
+        self.steps = []
+        self._write()
+
+    def add(self, step):
+        """
+        append a finished step to the log
+        """
+        step = self.encode(step)
+        self.steps.append(step)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(step) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def drop_last(self):
+        """
+        forget the last step, when its transaction didn't commit
+        """
+        self.steps.pop()
+        self._write()
+
+    @staticmethod
+    def encode(value):
+        """
+        value as it's read back from the log
+        """
+        return json.loads(json.dumps(value, cls=DjangoJSONEncoder))
+
+    def _write(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            for record in [self.header] + self.steps:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary_path, self.path)
+
+
+def dump_pk_map(pk_map):
+    """
+    own entries of a pk map as [key, [[old pk, new pk], ...]] pairs
+    keys are model labels, or [model label, attname] for other referenced fields
+    """
+    data = []
+    for key_model in pk_map.models():
+        if isinstance(key_model, tuple):
+            key = [key_model[0]._meta.label, key_model[1]]
+        else:
+            key = key_model._meta.label
+        data.append([key, [[old, new] for old, new in pk_map[key_model].items()]])
+    return data
+
+
+def load_pk_map(pk_map, data):
+    """
+    add the entries of dump_pk_map to a pk map
+    """
+    for key, pairs in data:
+        if isinstance(key, list):
+            model = apps.get_model(key[0])
+            key_model = (model, key[1])
+            field = next(field for field in model._meta.concrete_fields if field.attname == key[1])
+        else:
+            key_model = model = apps.get_model(key)
+            field = model._meta.pk
+        for old, new in pairs:
+            pk_map.add(key_model, field.to_python(old), field.to_python(new))
@@ -22,12 +22,241 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from copy import copy
+from multiprocessing.pool import ThreadPool
+from time import time
 
-from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Case, IntegerField, Q, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.apps import apps
 
+from django_clone.cache import DiscoveryCache, GraphSnapshot
+from django_clone.checkpoint import Checkpoint, dump_pk_map, load_pk_map
+from django_clone.pkmap import PkMap
+from django_clone.planning import ClonePlan
+from django_clone.sql import SqlCopier, can_copy_in_sql
+from django_clone.signals import clone_finished, clone_phase_finished
+from django_clone.stats import CloneStats, _QueryCounter
+from django_clone.sync import SyncState, get_version
+from django_clone.utils import chunks, get_in_list_size
+from django_clone.validation import Pending, find_unique_conflicts
+
+
+class CloneCycleError(ValueError):
+    """
+    raised when objects can't be ordered because their not-null
+    foreign keys depend on each other
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super(CloneCycleError, self).__init__(
+            "Unable to clone due to a cycle of not-null fields: %s" % " -> ".join(repr(node) for node in cycle))
+
+
+class CloneUniqueError(ValueError):
+    """
+    raised when copies would break unique constraints
+    conflicts holds (old object, names of the unique fields) of every conflict
+    """
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super(CloneUniqueError, self).__init__(
+            "Unable to clone due to unique fields. Use an editor to modify unique values before saving: %s" %
+            ", ".join("%r (%s)" % (obj, ", ".join(field_names)) for obj, field_names in conflicts))
+
+
+class BatchEditor(object):
+    """
+    editor that modifies all pending copies of one model at once
+    an instance can be passed to a clone instead of a per-object editor, and
+    edit is called with every model and the list of its unsaved copies
+    streaming clones call it once per chunk of copies
+    """
+
+    def edit(self, model, objs):
+        """
+        return the copies to save, one for every copy and in the same order
+        """
+        return objs
+
+
+def _topological_sort(nodes, dependencies, break_cycles=False):
+    """
+    order nodes so that every node comes after all of its dependencies
+    with break_cycles=True a dependency of every cycle is dropped instead of raising
+    """
+    in_degree = OrderedDict((node, 0) for node in nodes)
+    dependents = dict((node, []) for node in nodes)
+    for node in nodes:
+        for dependency in dependencies.get(node, ()):
+            in_degree[node] += 1
+            dependents[dependency].append(node)
+
+    ready = deque(node for node, degree in in_degree.items() if degree == 0)
+    order = []
+    while True:
+        while ready:
+            node = ready.popleft()
+            order.append(node)
+            for dependent in dependents[node]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) == len(in_degree):
+            return order
+        cycle = _find_cycle(in_degree, dependencies)
+        if not break_cycles:
+            raise CloneCycleError(cycle)
+        # The first node of the cycle is ordered before its dependency.
+        node, dependency = cycle[0], cycle[1]
+        dependencies[node] = set(dependencies[node]) - set([dependency])
+        dependents[dependency] = [dependent for dependent in dependents[dependency] if dependent != node]
+        in_degree[node] -= 1
+        if in_degree[node] == 0:
+            ready.append(node)
+
+
+def _split_levels(nodes, dependencies, break_cycles=False):
+    """
+    group nodes into levels in dependency order, so that every node
+    only depends on nodes of earlier levels
+    """
+    levels = OrderedDict()
+    for node in _topological_sort(nodes, dependencies, break_cycles):
+        levels[node] = max([levels[dependency] + 1 for dependency in dependencies.get(node, ())] + [0])
+    grouped = [[] for level in range(max(levels.values()) + 1 if levels else 0)]
+    for node, level in levels.items():
+        grouped[level].append(node)
+    return grouped
+
+
+def _find_cycle(in_degree, dependencies):
+    """
+    find a cycle among the nodes that couldn't be ordered
+    every one of them depends on at least one other node that couldn't be ordered
+    """
+    node = next(node for node, degree in in_degree.items() if degree > 0)
+    path = []
+    position = {}
+    while node not in position:
+        position[node] = len(path)
+        path.append(node)
+        node = next(dependency for dependency in dependencies[node] if in_degree[dependency] > 0)
+    return path[position[node]:] + [node]
+
+
+@contextmanager
+def _savepoint(using, enabled=True):
+    """
+    run a block inside a savepoint, or as it is when disabled
+    """
+    if enabled:
+        with transaction.atomic(using=using):
+            yield
+    else:
+        yield
+
+
+def _can_return_bulk_pks(model, using):
+    """
+    whether bulk_create sets the primary keys of new instances of a model
+    """
+    if not isinstance(model._meta.pk, AutoField):
+        return True
+    features = connections[using].features
+    return (getattr(features, "can_return_rows_from_bulk_insert", False) or
+            getattr(features, "can_return_ids_from_bulk_insert", False))
+
+
+def _has_integer_pk(model):
+    """
+    whether the primary key of a model, or of the parent that it links to, is an integer
+    """
+    field = model._meta.pk
+    while field.is_relation:
+        field = field.target_field
+    return isinstance(field, (AutoField, IntegerField))
+
+
+def _get_accessor_name(field):
+    """
+    name of the attribute that is used to access a relation from an object
+    """
+    field_name = field.name
+    if not (field.many_to_one or field.one_to_one) and field.auto_created:
+        if field.related_name is not None:
+            field_name = field.related_name
+        else:
+            field_name += "_set"
+    return field_name
+
+
+class ModelPlan(object):
+    """
+    relation metadata of a model that is needed to clone its objects
+    it is computed once per model and cloner
+    """
+
+    def __init__(self, model, ignored_field_names=()):
+        self.model = model
+        # The model itself and every model whose table holds a part of its rows.
+        self.models = [model] + list(model._meta.get_parent_list())
+        # Names of the attributes that are used to create a copy.
+        self.copy_fields = []
+        # Concrete foreign keys except the parent links.
+        self.foreign_keys = []
+        # Forward many-to-many fields that are copied after the objects.
+        self.many_to_many_fields = []
+        # Reverse parent links to the subclasses of the model.
+        self.parent_links = []
+        # Names of the attributes other than the pk that foreign keys point to.
+        self.referenced_fields = []
+        # (field, accessor name) of the relations that are followed during discovery.
+        self.relations = []
+
+        for field in model._meta.get_fields():
+            if not field.is_relation:
+                if not field.auto_created:
+                    self.copy_fields.append(field.name)
+                continue
+
+            if field.auto_created and not field.concrete and (field.one_to_many or field.one_to_one):
+                target_field = field.field.target_field
+                if not target_field.primary_key and target_field.attname not in self.referenced_fields:
+                    self.referenced_fields.append(target_field.attname)
+
+            accessor_name = _get_accessor_name(field)
+            # We deliberately check the exact type
+            # to provide more control when using inheritance.
+            if accessor_name not in ignored_field_names:
+                self.relations.append((field, accessor_name))
+
+            if field.one_to_one and getattr(field, "parent_link", False):
+                self.parent_links.append(field)
+            if field.auto_created:
+                continue
+            parent_link = field.one_to_one and getattr(field.remote_field, "parent_link", False)
+            if field.many_to_many:
+                self.many_to_many_fields.append(field)
+            elif parent_link or field.one_to_many:
+                continue
+            elif field.concrete:
+                self.foreign_keys.append(field)
+                self.copy_fields.append(field.attname)
+            else:
+                self.copy_fields.append(field.name)
+
+        # Not-null foreign keys to the model itself, which order its rows.
+        self.self_references = [field for field in self.foreign_keys
+                                if not field.null and field.related_model in self.models]
+
 
 class Cloner(object):
 
@@ -38,9 +267,30 @@ class Cloner(object):
         self.ignored_fields = []
         self.ignored_instances = {}
         self.blocking_instances = []
+        self._model_plans = {}
+        # Statistics of the last clone.
+        self.last_stats = None
+        self.discovery_cache = None
+        # Keys that the rows written by a clone refer to, while a discovery cache is used.
+        self._written_references = None
 
         self.apply_limits(*args, **kwargs)
 
+    def use_discovery_cache(self, max_size=128):
+        """
+        keep the graphs that clones discover, so cloning the same objects
+        again doesn't read them again
+        a graph is dropped when one of its objects is saved or deleted, when
+        a saved object or a copy that this cloner writes refers to it, or when
+        its many-to-many relations change, other writes that don't send signals
+        (like QuerySet.update) aren't noticed
+        """
+        self.discovery_cache = DiscoveryCache(max_size)
+        post_save.connect(self._invalidate_saved_object)
+        post_delete.connect(self._invalidate_deleted_object)
+        m2m_changed.connect(self._invalidate_many_to_many)
+        return self
+
     def apply_limits(self,
                      ignored_models=None,
                      ignored_instances=None,
@@ -59,191 +309,1509 @@ class Cloner(object):
         if blocking_instances:
             self.blocking_instances.extend(blocking_instances)
 
+        # The rules are compiled into sets, so every check is a single lookup.
+        # We deliberately check the exact type
+        # to provide more control when using inheritance.
+        self._ignored_models = frozenset(self.ignored_models)
+        self._blocking_models = frozenset(self.blocking_models)
+        self._blocking_instances = frozenset(self._get_instance_key(instance)
+                                             for instance in self.blocking_instances)
+        self._ignored_instances = dict((self._get_instance_key(old_object), new_object)
+                                       for old_object, new_object in self.ignored_instances.items())
+        ignored_field_names = {}
+        for model, field_name in self.ignored_fields:
+            ignored_field_names.setdefault(model, set()).add(field_name)
+        self._ignored_field_names = dict((model, frozenset(names))
+                                         for model, names in ignored_field_names.items())
+
+        # The ignored fields are part of the plans.
+        self._model_plans.clear()
+        if self.discovery_cache is not None:
+            self.discovery_cache.clear()
         return self
 
+    @staticmethod
+    def _get_instance_key(obj):
+        """
+        key that identifies an instance the same way model equality does
+        """
+        return obj._meta.concrete_model, obj.pk
+
+    def _get_model_plan(self, model):
+        """
+        memoized relation metadata of a model
+        """
+        plan = self._model_plans.get(model)
+        if plan is None:
+            plan = self._model_plans[model] = ModelPlan(model, self._ignored_field_names.get(model, ()))
+        return plan
 
     def get_all_neighbor_objects(self, obj):
         """
         find all objects that are adjacent to specific object
+        keys are read like in discovery, so related objects are never
+        loaded one by one
+        """
+        model = obj.__class__
+        keys = []
+        for field, field_name in self._get_model_plan(model).relations:
+            if field.concrete and (field.many_to_one or field.one_to_one) and field.target_field.primary_key:
+                # Forward keys are read from the object, with its unsaved changes. This
+                # includes the parent row, which discovery skips as a part of the same object.
+                value = getattr(obj, field.attname)
+                if value is not None:
+                    keys.append((field.related_model, value))
+                continue
+            keys.extend(self._get_related_pks_of_field(field, field_name, model, [obj.pk], None))
+        pks_by_model = OrderedDict()
+        for key_model, pk in keys:
+            pks_by_model.setdefault(key_model, set()).add(pk)
+        using = router.db_for_read(model, instance=obj)
+        return self._load_objects((), [(key_model, sorted(pks)) for key_model, pks in pks_by_model.items()],
+                                  get_in_list_size(using))
+
+    def get_all_related_object(self, obj):
         """
-        return_list = []
-        for field in obj._meta.get_fields():
-            if field.is_relation:
-                if field.many_to_one or field.one_to_one:
-                    field_name = field.name
+        find all object that are related to one object
+        """
+        chunk_size = get_in_list_size(router.db_for_read(obj.__class__, instance=obj))
+        return self._load_objects([obj], self._get_all_related_pks([obj], chunk_size).items(), chunk_size)
+
+    def _get_cached_related_objects(self, objs, using):
+        """
+        find all objects that are related to any of a list of objects, through
+        the discovery cache if there is one
+        """
+        cache = self.discovery_cache
+        if cache is None:
+            return self._get_objects_to_copy(objs, using)
+
+        root_key = tuple(self._get_instance_key(obj) for obj in objs)
+        snapshot = cache.get(root_key)
+        if snapshot is not None:
+            # The roots are copied as they were passed, like without the cache.
+            roots = dict(((obj.__class__, obj.pk), obj) for obj in objs)
+            return [roots.get((old_object.__class__, old_object.pk), old_object)
+                    for old_object in snapshot.get_objects(using)]
+        old_objects = self._get_objects_to_copy(objs, using)
+        keys = []
+        expanded_keys = []
+        for obj in old_objects:
+            object_keys = self._get_cache_keys(obj)
+            keys.extend(object_keys)
+            if not self._is_blocked(obj):
+                expanded_keys.extend(object_keys)
+        cache.set(root_key, GraphSnapshot(old_objects, keys, expanded_keys))
+        return old_objects
+
+    def _get_objects_to_copy(self, objs, using):
+        """
+        find all objects that are related to any of a list of objects
+        the graph is discovered by reading keys only, and then the full rows
+        of the objects that are copied are loaded with one query per chunk
+        of every model, objects of ignored models are only made from their pk
+        """
+        def keys_only(model, pk):
+            # They map to themselves, so only their keys are needed.
+            return model in self._ignored_models and (model._meta.concrete_model, pk) not in self._ignored_instances
+
+        chunk_size = get_in_list_size(using)
+        pks_by_model = self._get_all_related_pks(objs, chunk_size)
+        return self._load_objects(objs, pks_by_model.items(), chunk_size, keys_only)
+
+    @staticmethod
+    def _load_objects(roots, pks_by_model, chunk_size, keys_only=None):
+        """
+        objects of (model, pks) pairs, loaded with one query per chunk of every model
+        roots are used as they were passed, with their unsaved changes, and
+        the objects that keys_only(model, pk) is true for are only made from their pk
+        """
+        roots = dict(((obj.__class__, obj.pk), obj) for obj in roots)
+        objects = []
+        for model, pks in pks_by_model:
+            loaded_pks = []
+            for pk in pks:
+                if (model, pk) in roots:
+                    objects.append(roots[(model, pk)])
+                elif keys_only is not None and keys_only(model, pk):
+                    objects.append(model(pk=pk))
                 else:
-                    field_name = field.name
-                    if field.auto_created:
-                        if field.related_name is not None:
-                            field_name = field.related_name
-                        else:
-                            field_name += "_set"
-
-                # Check whether this field should be ignored.
-                # We deliberately check the exact type
-                # to provide more control when using inheritance.
-
-                blocked = False
-
-                for model, blocked_field_name in self.ignored_fields:
-                    if type(obj) == model and field_name == blocked_field_name:
-                        blocked = True
-                        break
-                if blocked:
+                    loaded_pks.append(pk)
+            for chunk in chunks(loaded_pks, chunk_size):
+                objects.extend(model._base_manager.filter(pk__in=chunk))
+        return objects
+
+    @contextmanager
+    def _invalidate_written_references(self):
+        """
+        run a block that writes copies and drop the cached graphs that they refer to
+        the copies are written without signals, so they're noticed here
+        """
+        if self.discovery_cache is None:
+            yield
+            return
+        self._written_references = set()
+        try:
+            yield
+        finally:
+            self.discovery_cache.invalidate(references=self._written_references)
+            self._written_references = None
+
+    def _invalidate_saved_object(self, sender, instance, **kwargs):
+        references = [self._get_related_key(field, instance) for field in instance._meta.concrete_fields
+                      if field.many_to_one or field.one_to_one]
+        self.discovery_cache.invalidate(self._get_cache_keys(instance), references)
+
+    def _invalidate_deleted_object(self, sender, instance, **kwargs):
+        self.discovery_cache.invalidate(self._get_cache_keys(instance))
+
+    def _invalidate_many_to_many(self, sender, instance, action, model, pk_set, **kwargs):
+        if action.startswith("post_"):
+            references = self._get_cache_keys(instance) + [(model, pk) for pk in pk_set or ()]
+            self.discovery_cache.invalidate(references=references)
+
+    def _get_cache_keys(self, obj):
+        return [(key_model, value) for key_model, value, attname in self._get_object_keys(obj)]
+
+    def _is_blocked(self, obj):
+        return type(obj) in self._blocking_models or self._get_instance_key(obj) in self._blocking_instances
+
+    @staticmethod
+    def _get_related_objects_of_object(field, field_name, obj):
+        if field.many_to_one or field.one_to_one:
+            fld = getattr(obj, field_name, None)
+            return [fld] if fld is not None else []
+        return list(getattr(obj, field_name).all())
+
+    def plan(self, obj):
+        """
+        report what cloning an object would do, without writing anything
+        only primary keys and counts are read, so it's cheap enough to run
+        before a large clone
+        the estimated number of queries is for a clone with the default options
+        """
+        using = router.db_for_write(obj.__class__, instance=obj)
+        chunk_size = get_in_list_size(using) or 1000
+        clone_plan = ClonePlan()
+        counter = _QueryCounter([using])
+        with counter:
+            pks_by_model = self._get_all_related_pks([obj], chunk_size, clone_plan.pruned_edges)
+            # Discovery loads the same relations with the same number of queries.
+            clone_plan.estimated_queries += counter.count
+
+            root_key = (obj.__class__, obj.pk)
+            queue_by_model = OrderedDict()
+            for model, pks in pks_by_model.items():
+                loaded = 0
+                for pk in pks:
+                    ignored_instance = (model._meta.concrete_model, pk) in self._ignored_instances
+                    if model in self._ignored_models or ignored_instance:
+                        clone_plan.ignored_objects[model._meta.label] += 1
+                    else:
+                        queue_by_model.setdefault(model, []).append(pk)
+                    if (model not in self._ignored_models or ignored_instance) and (model, pk) != root_key:
+                        loaded += 1
+                # The full rows are loaded in chunks after the discovery, except the root.
+                clone_plan.estimated_queries += (loaded + chunk_size - 1) // chunk_size
+            del pks_by_model
+
+            dependencies = self._get_model_dependencies(queue_by_model)
+            try:
+                order = _topological_sort(list(queue_by_model), dependencies)
+            except CloneCycleError as error:
+                clone_plan.cycle = [model._meta.label for model in error.cycle]
+                order = _topological_sort(list(queue_by_model), dependencies, break_cycles=True)
+            clone_plan.order = [model._meta.label for model in order]
+            for model in order:
+                if clone_plan.cycle is None:
+                    try:
+                        self._split_self_references(model, queue_by_model[model], chunk_size)
+                    except CloneCycleError as error:
+                        clone_plan.cycle = [(model._meta.label, old_object.pk) for old_object in error.cycle]
+
+            copied_models = set()
+            for model in queue_by_model:
+                copied_models.update(self._get_model_plan(model).models)
+            for model, pks in queue_by_model.items():
+                plan = self._get_model_plan(model)
+                clone_plan.objects[model._meta.label] += len(pks)
+                # Every table of the model gets one insert per object.
+                clone_plan.estimated_queries += len(pks) * len(plan.models)
+                for model_class, fields in self._get_unique_checks(model):
+                    if any(field.is_relation and field.related_model in copied_models for field in fields):
+                        # The copies point to other copies.
+                        continue
+                    lookups = dict((field.name + "__isnull", False) for field in fields)
+                    number = sum(model._base_manager.filter(pk__in=chunk, **lookups).count()
+                                 for chunk in chunks(pks, chunk_size))
+                    if number:
+                        clone_plan.unique_conflicts[(model._meta.label, tuple(field.name for field in fields))] += number
+                        # Complete values are checked in batches.
+                        batch = chunk_size // len(fields)
+                        clone_plan.estimated_queries += (number + batch - 1) // batch
+                for field in plan.many_to_many_fields:
+                    through = field.remote_field.through
+                    source_name = through._meta.get_field(field.m2m_field_name()).attname
+                    for chunk in chunks(pks, chunk_size):
+                        clone_plan.estimated_queries += 1
+                        if through in queue_by_model:
+                            # The rows are cloned as objects.
+                            continue
+                        if through._default_manager.filter(**{source_name + "__in": chunk}).exists():
+                            clone_plan.estimated_queries += 1
+
+        if connections[using].features.uses_savepoints:
+            # The inserts and the many-to-many rows are copied in savepoints,
+            # and so is the whole clone when it runs inside a transaction.
+            clone_plan.estimated_queries += 6 if connections[using].in_atomic_block else 4
+        clone_plan.queries = counter.count
+        return clone_plan
+
+    @staticmethod
+    def _get_unique_checks(model):
+        """
+        (model class, fields) of the unique constraints that copies of a model
+        are checked against, except the ones that include a primary key
+        """
+        unique_checks, date_checks = model()._get_unique_checks()
+        for model_class, field_names in unique_checks:
+            fields = [model._meta.get_field(name) for name in field_names]
+            if not any(field.primary_key for field in fields):
+                yield model_class, fields
+
+    def clone(self, obj, editor=None, **options):
+        """
+        make copy of every objects that are related to one object
+        the options are the same as clone_many
+        """
+        return self.clone_many([obj], editor, **options)[obj]
+
+    def clone_many(self, objs, editor=None, bulk=False, batch_size=None, atomic=True, defer_constraints=False,
+                   count_queries=False, streaming=False, chunk_size=1000, workers=1, sql=False, source=None,
+                   target=None):
+        """
+        make copy of every objects that are related to any of a list of objects
+        the graph is discovered and copied once, so objects that are shared
+        between the roots are only copied once
+        returns a dict that maps every one of the objects to its copy
+        with bulk=True models are inserted in dependency order
+        using bulk_create in batches of batch_size
+        with atomic=True the whole clone runs in one transaction, with
+        a savepoint per phase, so a failure doesn't leave a partial copy
+        with defer_constraints=True not-null references that form a cycle are
+        patched after all rows are inserted, which relies on the foreign key
+        checks that Django creates being deferred to the commit
+        statistics of the clone are kept in last_stats, and queries are
+        counted per phase with count_queries=True
+        with streaming=True only primary keys are kept in memory and the
+        rows are loaded and inserted model by model, chunk_size at a time
+        with workers > 1 a streaming clone copies independent models, and shards
+        of large models, in that many threads with their own connections
+        every thread commits its own part, so it needs atomic=False
+        with sql=True an atomic streaming clone copies the rows of models without
+        subclass tables or unique fields inside the database, with
+        INSERT ... SELECT, unless there is an editor
+        the editor is called with every copy before it's saved, or it can be
+        a BatchEditor, which gets all copies of one model at once
+        source and target are the aliases of the databases that the objects are
+        read from and the copies are written to, they default to the routers
+        a clone between databases is always streamed, and every model is
+        written with bulk_create in batches of batch_size where the target
+        returns the new primary keys
+        """
+        objs = list(objs)
+        if not objs:
+            return OrderedDict()
+        if defer_constraints and not atomic:
+            raise ValueError("Deferred constraints need an atomic clone")
+        if workers > 1 and (atomic or not streaming):
+            raise ValueError("Parallel clones need streaming=True and atomic=False")
+        if sql and (workers > 1 or not streaming or not atomic):
+            # New keys are reserved before the rows are inserted, which needs a transaction.
+            raise ValueError("SQL copies need streaming=True, atomic=True and a single worker")
+
+        using = target or router.db_for_write(objs[0].__class__, instance=objs[0])
+        aliases = [using] if source in (None, using) else [source, using]
+        stats = self.last_stats = CloneStats()
+        with stats.collect(aliases, count_queries), self._invalidate_written_references():
+            if streaming or source is not None or target is not None:
+                clone = lambda: self._stream_clone(objs, editor, chunk_size, batch_size, atomic, defer_constraints,
+                                                   workers, sql, source, target)
+            else:
+                clone = lambda: self._clone(objs, editor, bulk, batch_size, atomic, defer_constraints)
+            if not atomic:
+                new_objects = clone()
+            else:
+                with transaction.atomic(using=using):
+                    new_objects = clone()
+        clone_finished.send(sender=self.__class__, cloner=self, stats=stats)
+        return new_objects
+
+    def clone_resumable(self, obj, checkpoint, editor=None, chunk_size=1000, batch_size=None, progress=None):
+        """
+        make copy of every objects that are related to one object, like a
+        streaming clone without a transaction, and log the pk map and the
+        progress of every phase to a checkpoint file after every chunk
+        every chunk is committed on its own, and running the clone again with
+        the same checkpoint resumes it after the last committed chunk
+        progress(model label, done rows, all rows, rows per second) is
+        called after every chunk that is inserted
+        returns the copy of the object
+        """
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        using = router.db_for_write(obj.__class__, instance=obj)
+        root = [obj._meta.label, obj.pk]
+
+        stats = self.last_stats = CloneStats()
+        with stats.collect([using]), self._invalidate_written_references():
+            pk_map = PkMap()
+            if checkpoint.load():
+                if checkpoint.header["root"] != checkpoint.encode(root):
+                    raise ValueError("The checkpoint %s belongs to the clone of another object" % checkpoint.path)
+                chunk_size = checkpoint.header["chunk_size"]
+                load_pk_map(pk_map, checkpoint.header["ignored"])
+                queue = []
+                for label, pks in checkpoint.header["queue"]:
+                    model = apps.get_model(label)
+                    queue.append((model, [model._meta.pk.to_python(pk) for pk in pks]))
+                self._check_last_step(checkpoint)
+            else:
+                chunk_size = min(chunk_size, get_in_list_size(using) or chunk_size)
+                with self._phase("discovery"):
+                    pks_by_model = self._get_all_related_pks([obj], chunk_size)
+                queue_by_model = self._queue_related_pks(pks_by_model, pk_map)
+                dependencies = self._get_model_dependencies(queue_by_model)
+                queue = []
+                for model in _topological_sort(list(queue_by_model), dependencies):
+                    # Rows that refer to rows of the same model come after them.
+                    levels = self._split_self_references(model, queue_by_model[model], chunk_size)
+                    queue.append((model, [pk for level in levels for pk in level]))
+                checkpoint.start({
+                    "root": root,
+                    "chunk_size": chunk_size,
+                    "queue": [[model._meta.label, pks] for model, pks in queue],
+                    "ignored": dump_pk_map(pk_map),
+                })
+
+            queued = self._get_queued_keys(queue, chunk_size)
+            finished = set()
+            deferred_relations = OrderedDict()
+            for step in checkpoint.steps:
+                if step["phase"] == "insert":
+                    load_pk_map(pk_map, step["pk_map"])
+                    model = apps.get_model(step["model"])
+                    for field_name, pks in step["deferred_relations"]:
+                        deferred_relations.setdefault((model, model._meta.get_field(field_name)), []).extend(
+                            model._meta.pk.to_python(pk) for pk in pks)
+                finished.add((step["phase"], step["model"], step.get("field"), step.get("chunk")))
+
+            with self._phase("insert"):
+                for model, pks in queue:
+                    start, done = time(), 0
+                    for index, chunk in enumerate(chunks(pks, chunk_size)):
+                        if ("insert", model._meta.label, None, index) in finished:
+                            continue
+                        chunk_map = PkMap(parent=pk_map)
+                        chunk_deferred_relations = OrderedDict()
+                        with transaction.atomic(using=using):
+                            self._stream_save_model(model, chunk, queued, chunk_map, editor, chunk_size, batch_size,
+                                                    chunk_deferred_relations, stats, target=using)
+                            checkpoint.add({
+                                "phase": "insert", "model": model._meta.label, "chunk": index,
+                                "pk_map": dump_pk_map(chunk_map),
+                                "deferred_relations": [[field.name, old_pks] for (chunk_model, field), old_pks
+                                                       in chunk_deferred_relations.items()],
+                            })
+                        pk_map.update(chunk_map)
+                        for key, old_pks in chunk_deferred_relations.items():
+                            deferred_relations.setdefault(key, []).extend(old_pks)
+                        done += len(chunk)
+                        if progress is not None:
+                            progress(model._meta.label, index * chunk_size + len(chunk), len(pks),
+                                     done / max(time() - start, 1e-9))
+
+                with self.last_stats.phase("relations"):
+                    for (model, field), old_pks in deferred_relations.items():
+                        if ("relations", model._meta.label, field.name, None) in finished:
+                            continue
+                        # Setting a reference to its copy again does no harm.
+                        with transaction.atomic(using=using):
+                            self._stream_update_relations(model, field, old_pks, pk_map, chunk_size, batch_size,
+                                                          target=using)
+                            checkpoint.add({"phase": "relations", "model": model._meta.label, "field": field.name})
+
+            with self._phase("many_to_many"):
+                for model, pks in queue:
+                    for index, chunk in enumerate(chunks(pks, chunk_size)):
+                        if ("many_to_many", model._meta.label, None, index) in finished:
+                            continue
+                        with transaction.atomic(using=using):
+                            self._copy_many_to_many({model: chunk}, queued, pk_map, chunk_size, batch_size,
+                                                    target=using)
+                            checkpoint.add({"phase": "many_to_many", "model": model._meta.label, "chunk": index})
+
+            new_object = obj.__class__._base_manager.db_manager(using).get(pk=pk_map.get(obj.__class__, obj.pk))
+        clone_finished.send(sender=self.__class__, cloner=self, stats=stats)
+        return new_object
+
+    def _check_last_step(self, checkpoint):
+        """
+        forget the last step of a checkpoint if the process died
+        before its transaction was committed
+        """
+        if not checkpoint.steps:
+            return
+        step = checkpoint.steps[-1]
+        model = apps.get_model(step["model"])
+        committed = True
+        if step["phase"] == "relations":
+            # Setting a reference to its copy again does no harm, so the step is always redone.
+            committed = False
+        elif step["phase"] == "insert":
+            chunk_map = PkMap()
+            load_pk_map(chunk_map, step["pk_map"])
+            new_pks = [new_pk for old_pk, new_pk in chunk_map[model].items()]
+            committed = not new_pks or model._base_manager.filter(pk=new_pks[0]).exists()
+        elif step["phase"] == "many_to_many":
+            # The copies of the chunk are the sources of every row it wrote.
+            chunk_map = PkMap()
+            for insert_step in checkpoint.steps:
+                if insert_step["phase"] == "insert" and insert_step["model"] == step["model"]:
+                    load_pk_map(chunk_map, insert_step["pk_map"])
+            chunk_size = checkpoint.header["chunk_size"]
+            pks = dict(checkpoint.header["queue"])[step["model"]]
+            pks = pks[step["chunk"] * chunk_size:(step["chunk"] + 1) * chunk_size]
+            new_pks = [chunk_map.get(model, model._meta.pk.to_python(pk)) for pk in pks]
+            committed = False
+            for field in self._get_model_plan(model).many_to_many_fields:
+                through = field.remote_field.through
+                source_name = through._meta.get_field(field.m2m_field_name()).attname
+                if through._default_manager.filter(**{source_name + "__in": new_pks}).exists():
+                    committed = True
+        if not committed:
+            checkpoint.drop_last()
+
+    def sync(self, obj, state, editor=None, chunk_size=1000, batch_size=None, updated_field=None):
+        """
+        keep a copy of every objects that are related to one object up to date
+        the first sync clones the graph and keeps the mapping of the copies in
+        a state file, later syncs only insert copies of new rows, update the
+        copies of changed rows and delete the copies of removed rows
+        rows are compared by a digest of their field values, or by the value
+        of updated_field in the models that have it
+        the sync runs in one transaction, and returns the copy of the object
+        """
+        if not isinstance(state, SyncState):
+            state = SyncState(state)
+        using = router.db_for_write(obj.__class__, instance=obj)
+        chunk_size = min(chunk_size, get_in_list_size(using) or chunk_size)
+        root = state.encode([obj._meta.label, obj.pk])
+        if state.load() and state.root != root:
+            raise ValueError("The state %s belongs to the copy of another object" % state.path)
+        state.root = root
+
+        stats = self.last_stats = CloneStats()
+        with stats.collect([using]), self._invalidate_written_references():
+            with transaction.atomic(using=using):
+                new_object = self._sync(obj, state, editor, chunk_size, batch_size, updated_field)
+        state.save()
+        clone_finished.send(sender=self.__class__, cloner=self, stats=stats)
+        return new_object
+
+    def _sync(self, obj, state, editor, chunk_size, batch_size, updated_field):
+        pk_map = PkMap()
+        with self._phase("discovery"):
+            pks_by_model = self._get_all_related_pks([obj], chunk_size)
+        queue_by_model = self._queue_related_pks(pks_by_model, pk_map)
+        del pks_by_model
+        copied = self._get_queued_keys(queue_by_model.items(), chunk_size)
+
+        # Rows that were copied before map to their copies from the start.
+        versions = OrderedDict()
+        new_rows = OrderedDict()
+        changed_rows = OrderedDict()
+        with self._phase("diff"):
+            for model, pks in queue_by_model.items():
+                plan = self._get_model_plan(model)
+                previous = state.rows.get(model, {})
+                versions[model] = self._get_versions(model, pks, chunk_size, updated_field)
+                for pk in pks:
+                    if pk not in previous:
+                        new_rows.setdefault(model, []).append(pk)
+                        continue
+                    new_pk, version = previous[pk]
+                    for parent in plan.models:
+                        pk_map.add(parent, pk, new_pk)
+                    if version != versions[model][pk]:
+                        changed_rows.setdefault(model, []).append(pk)
+                self._map_referenced_fields(model, [pk for pk in pks if pk in previous], pk_map, chunk_size)
+            queued = self._get_queued_keys(new_rows.items(), chunk_size)
+
+        deferred_relations = OrderedDict()
+        with self._phase("insert"):
+            dependencies = self._get_model_dependencies(new_rows)
+            for model in _topological_sort(list(new_rows), dependencies):
+                self._stream_save_model(model, new_rows[model], queued, pk_map, editor, chunk_size, batch_size,
+                                        deferred_relations, self.last_stats)
+            with self.last_stats.phase("relations"):
+                for (model, field), old_pks in deferred_relations.items():
+                    self._stream_update_relations(model, field, old_pks, pk_map, chunk_size, batch_size)
+            self.last_stats.deferred_relations += sum(len(old_pks) for old_pks in deferred_relations.values())
+
+        with self._phase("update"):
+            for model, pks in changed_rows.items():
+                self._update_copies(model, pks, pk_map, editor, chunk_size, batch_size)
+
+        with self._phase("many_to_many"):
+            self._sync_many_to_many(queue_by_model, copied, pk_map, chunk_size, batch_size)
+
+        with self._phase("delete"):
+            for model, rows in state.rows.items():
+                removed = [new_pk for old_pk, (new_pk, version) in rows.items()
+                           if old_pk not in versions.get(model, {})]
+                for chunk in chunks(removed, chunk_size):
+                    deleted, deleted_by_label = model._base_manager.filter(pk__in=chunk).delete()
+                    self.last_stats.deleted_objects.update(deleted_by_label)
+
+        state.rows = OrderedDict()
+        for model, pks in queue_by_model.items():
+            state.rows[model] = dict((pk, (pk_map.get(model, pk), versions[model][pk])) for pk in pks)
+        return obj.__class__._base_manager.get(pk=pk_map.get(obj.__class__, obj.pk))
+
+    def _get_versions(self, model, pks, chunk_size, updated_field=None):
+        """
+        version of every row of a model, a digest of the values that are
+        copied, or of updated_field if the model has it
+        """
+        fields = self._get_version_fields(model)
+        if updated_field is not None and any(field.name == updated_field for field in fields):
+            names = [updated_field]
+        else:
+            names = [field.attname for field in fields]
+        versions = {}
+        for chunk in chunks(pks, chunk_size):
+            for row in model._base_manager.filter(pk__in=chunk).values_list("pk", *names):
+                versions[row[0]] = get_version(row[1:])
+        return versions
+
+    @staticmethod
+    def _get_version_fields(model):
+        """
+        concrete fields that a copy takes from its original
+        """
+        return [field for field in model._meta.concrete_fields
+                if not field.primary_key and not (field.one_to_one and field.remote_field.parent_link)]
+
+    def _map_referenced_fields(self, model, old_pks, pk_map, chunk_size):
+        """
+        add the values of the fields other than the pk that foreign keys point
+        to, of rows that were copied before, to the pk map
+        """
+        keys = [(key_model, attname) for key_model in self._get_model_plan(model).models
+                for attname in self._get_model_plan(key_model).referenced_fields]
+        if not keys:
+            return
+        attnames = [attname for key_model, attname in keys]
+        for chunk in chunks(old_pks, chunk_size):
+            old_rows = model._base_manager.filter(pk__in=chunk).values_list("pk", *attnames)
+            new_rows = dict((row[0], row[1:]) for row in model._base_manager.filter(
+                pk__in=[pk_map.get(model, pk) for pk in chunk]).values_list("pk", *attnames))
+            for row in old_rows:
+                new_values = new_rows[pk_map.get(model, row[0])]
+                for key, old_value, new_value in zip(keys, row[1:], new_values):
+                    if old_value is not None:
+                        pk_map.add(key, old_value, new_value)
+
+    def _update_copies(self, model, pks, pk_map, editor, chunk_size, batch_size):
+        """
+        copy the values of changed rows to their existing copies
+        every field is set with one query per batch
+        """
+        plan = self._get_model_plan(model)
+        fields = self._get_version_fields(model)
+        for chunk in chunks(pks, chunk_size):
+            old_objects = list(model._base_manager.filter(pk__in=chunk))
+            new_objects = []
+            for old_object in old_objects:
+                new_object = copy(old_object)
+                new_object.pk = None
+                new_objects.append(new_object)
+            new_objects = self._edit_copies(model, new_objects, editor)
+
+            values_by_field = OrderedDict((field, {}) for field in fields)
+            for new_object, old_object in zip(new_objects, old_objects):
+                self._update_relations(new_object, old_object, pk_map, plan.foreign_keys)
+                new_pk = pk_map.get(model, old_object.pk)
+                for field in fields:
+                    values_by_field[field][new_pk] = getattr(new_object, field.attname)
+            # Fields of parents are updated in their own tables, where the copies have the same pk.
+            for field, values in values_by_field.items():
+                self._bulk_update(field.model, field, values, batch_size)
+            self.last_stats.updated_objects[model._meta.label] += len(old_objects)
+
+    def _sync_many_to_many(self, pks_by_model, copied, pk_map, chunk_size, batch_size=None):
+        """
+        make the rows of the through tables of the copies match the rows of their
+        originals, like _copy_many_to_many, by inserting the missing rows and
+        deleting the extra ones
+        """
+        for model, pks in pks_by_model.items():
+            for field in self._get_model_plan(model).many_to_many_fields:
+                through = field.remote_field.through
+                if not through._meta.auto_created:
+                    # Rows of explicit through models are synced as objects.
                     continue
+                source_field = through._meta.get_field(field.m2m_field_name())
+                target_field = through._meta.get_field(field.m2m_reverse_field_name())
+                symmetrical = field.remote_field.symmetrical
+                manager = through._default_manager
 
-                if field.many_to_one or field.one_to_one:
-                    fld = getattr(obj, field_name, None)
-                    if fld is not None:
-                        return_list.append(fld)
-                else:
-                    for fld in getattr(obj, field_name).all():
-                        return_list.append(fld)
-        return return_list
+                expected = set()
+                existing = {}
+                for chunk in chunks(pks, chunk_size):
+                    rows = manager.filter(**{source_field.attname + "__in": chunk}).values_list(
+                        source_field.attname, target_field.attname)
+                    for source, target in rows:
+                        new_source = self._map_related_value(source_field, source, pk_map)
+                        new_target = self._map_related_value(target_field, target, pk_map)
+                        expected.add((new_source, new_target))
+                        if symmetrical and (field.related_model, target) not in copied:
+                            expected.add((new_target, new_source))
 
-    def get_all_related_object(self, obj):
+                    new_pks = [self._map_related_value(source_field, pk, pk_map) for pk in chunk]
+                    lookups = [Q(**{source_field.attname + "__in": new_pks})]
+                    if symmetrical:
+                        lookups.append(Q(**{target_field.attname + "__in": new_pks}))
+                    for lookup in lookups:
+                        for row in manager.filter(lookup).values_list("pk", source_field.attname,
+                                                                      target_field.attname):
+                            existing[row[1:]] = row[0]
+
+                missing = [row for row in expected if row not in existing]
+                extra = [row_pk for row, row_pk in existing.items() if row not in expected]
+                if missing:
+                    manager.bulk_create([through(**{source_field.attname: source, target_field.attname: target})
+                                         for source, target in missing], batch_size=batch_size)
+                    self.last_stats.objects[through._meta.label] += len(missing)
+                for chunk in chunks(extra, chunk_size):
+                    manager.filter(pk__in=chunk).delete()
+                    self.last_stats.deleted_objects[through._meta.label] += len(chunk)
+
+    @contextmanager
+    def _phase(self, name):
         """
-        find all object that are related to one object
+        run a phase of a clone and report it when it's finished
+        """
+        with self.last_stats.phase(name):
+            yield
+        clone_phase_finished.send(sender=self.__class__, cloner=self, phase=name, stats=self.last_stats)
+
+    def _clone(self, objs, editor, bulk, batch_size, atomic, defer_constraints):
+        using = router.db_for_write(objs[0].__class__, instance=objs[0])
+
+        # Copies are identified by the (model, pk) of their old objects,
+        # which is also how foreign keys refer to them.
+        pk_map = PkMap()
+
+        with self._phase("discovery"):
+            old_objects = self._get_cached_related_objects(objs, using)
+
+        with self._phase("copy"):
+            save_queue, ignored = self._get_save_queue(old_objects, pk_map, editor)
+        del old_objects
+
+        queued = PkMap()
+        for index, (new_object, old_object) in enumerate(save_queue):
+            for key_model, value, attname in self._get_object_keys(old_object):
+                queued.add(key_model, value, index)
+
+        with self._phase("validation"):
+            self._validate_unique(save_queue, queued, pk_map)
+
+        with _savepoint(using, atomic), self._phase("insert"):
+            if bulk:
+                saved = self._bulk_save(save_queue, queued, pk_map, batch_size, defer_constraints, using)
+            else:
+                saved = self._save(save_queue, queued, pk_map, defer_constraints)
+
+        queue_by_model = OrderedDict()
+        for new_object, old_object in saved:
+            queue_by_model.setdefault(new_object.__class__, []).append(old_object.pk)
+        with _savepoint(using, atomic), self._phase("many_to_many"):
+            self._copy_many_to_many(queue_by_model, queued, pk_map, get_in_list_size(using), batch_size)
+
+        # The roots may have been replaced by their most derived instances.
+        root_keys = set((obj.__class__, obj.pk) for obj in objs)
+        new_objects_by_key = {}
+        for new_object, old_object in ignored + saved:
+            for model in self._get_model_plan(old_object.__class__).models:
+                if (model, old_object.pk) in root_keys:
+                    new_objects_by_key[(model, old_object.pk)] = new_object
+        return OrderedDict((obj, new_objects_by_key[(obj.__class__, obj.pk)]) for obj in objs)
+
+    def _stream_clone(self, objs, editor, chunk_size, batch_size, atomic, break_cycles, workers=1, sql=False,
+                      source=None, target=None):
+        """
+        clone model by model in chunks of chunk_size rows
+        discovery only reads primary keys, and only the rows of one chunk are
+        loaded at a time, so memory is bound by the pk map rather than the rows
+        rows are read from the source database and written to the target one,
+        both default to the routers
         """
-        def _get_all_related_object_recursively(obj, mark):
+        using = target or router.db_for_write(objs[0].__class__, instance=objs[0])
+        chunk_size = min(chunk_size, get_in_list_size(using) or chunk_size)
+        if source is not None:
+            chunk_size = min(chunk_size, get_in_list_size(source) or chunk_size)
+
+        with self._phase("discovery"):
+            pks_by_model = self._get_all_related_pks(objs, chunk_size, using=source)
+
+        pk_map = PkMap()
+        queue_by_model = self._queue_related_pks(pks_by_model, pk_map)
+        del pks_by_model
+        queued = self._get_queued_keys(queue_by_model.items(), chunk_size, source)
+
+        with _savepoint(using, atomic), self._phase("insert"):
+            if workers > 1:
+                deferred_relations = self._parallel_save(queue_by_model, queued, pk_map, editor, chunk_size,
+                                                         batch_size, workers, source, using)
+            else:
+                # Rows can only be copied inside a database when they are read from it.
+                sql_copier = None
+                if sql and editor is None and source in (None, using) and can_copy_in_sql(using):
+                    sql_copier = SqlCopier(using)
+                deferred_relations = self._stream_save(queue_by_model, queued, pk_map, editor, chunk_size,
+                                                       batch_size, break_cycles, sql_copier, source, using)
+            with self.last_stats.phase("relations"):
+                for (model, field), old_pks in deferred_relations.items():
+                    self._stream_update_relations(model, field, old_pks, pk_map, chunk_size, batch_size,
+                                                  source, using)
+
+        with _savepoint(using, atomic), self._phase("many_to_many"):
+            self._copy_many_to_many(queue_by_model, queued, pk_map, chunk_size, batch_size, source, using)
+
+        # The roots are returned as instances of the model they were copied as.
+        new_objects = OrderedDict()
+        for obj in objs:
+            model = obj.__class__
+            for queued_model, pks in queue_by_model.items():
+                index = bisect_left(pks, obj.pk)
+                if model in self._get_model_plan(queued_model).models and pks[index:index + 1] == [obj.pk]:
+                    model = queued_model
+                    break
+            new_objects[obj] = model._base_manager.db_manager(using).get(pk=pk_map.get(obj.__class__, obj.pk))
+        return new_objects
+
+    def _queue_related_pks(self, pks_by_model, pk_map):
+        """
+        split discovered keys into the ones to copy, which are returned as a
+        list of pks per model, and the ignored ones, which are added to pk_map
+        """
+        queue_by_model = OrderedDict()
+        for model, pks in pks_by_model.items():
+            plan = self._get_model_plan(model)
+            for pk in pks:
+                if (model._meta.concrete_model, pk) in self._ignored_instances or model in self._ignored_models:
+                    # Ignored objects map to themselves or to their replacements.
+                    match = self._ignored_instances.get((model._meta.concrete_model, pk))
+                    for parent in plan.models:
+                        pk_map.add(parent, pk, pk if match is None else match.pk)
+                    self.last_stats.ignored_objects[model._meta.label] += 1
+                    continue
+                queue_by_model.setdefault(model, []).append(pk)
+        return queue_by_model
+
+    def _get_queued_keys(self, queue, chunk_size, using=None):
+        """
+        pk map of every key that foreign keys can use to refer to the queued
+        rows to the pk of the row, from (model, pks) pairs
+        the values of the other fields that foreign keys point to are read
+        with one query per chunk of the models that have them
+        """
+        queued = PkMap()
+        for model, pks in queue:
+            keys = []
+            for key_model in self._get_model_plan(model).models:
+                for pk in pks:
+                    queued.add(key_model, pk, pk)
+                keys.extend((key_model, attname) for attname in self._get_model_plan(key_model).referenced_fields)
+            if not keys:
+                continue
+            manager = model._base_manager.db_manager(using)
+            for chunk in chunks(pks, chunk_size):
+                for row in manager.filter(pk__in=chunk).values_list("pk", *[attname for key_model, attname in keys]):
+                    for key, value in zip(keys, row[1:]):
+                        if value is not None:
+                            queued.add(key, value, row[0])
+        return queued
+
+    def _get_all_related_pks(self, objs, chunk_size, pruned_edges=None, using=None):
+        """
+        find the primary keys of all objects that are related to any of
+        a list of objects, grouped by the most derived model of every object
+        blocked objects are included but their relations aren't followed
+        relations that the rules stop at are counted in pruned_edges
+        per (model label, field name, rule)
+        the rows are read from the database of using if it's given
+        """
+        mark = set([])
+        included = OrderedDict()
+
+        def _visit(keys):
             """
-            recursively go to adjacent objects of an object and find related objects
-            it works like dfs
+            add non-blocked keys to the result if they haven't been visited yet
+            and return them grouped by model, so they will be expanded in the next level
             """
-            succeded_in_going_down = True
-            while succeded_in_going_down:
-                succeded_in_going_down = False
-                for field in obj._meta.get_fields():
-                    if field.is_relation and field.one_to_one and getattr(field, "parent_link", False):
-                        try:
-                            obj = getattr(obj, field.name)
-                            succeded_in_going_down = True
-                            break
-                        except:
-                            pass
-            if (obj.__class__, obj.pk) in mark:
-                return []
-            mark.update([(obj.__class__, obj.pk)])
-            return_list = [obj]
-            neighbors = self.get_all_neighbor_objects(obj)
-            for fld in neighbors:
-                blocked = False
-                for model in self.blocking_models:
-                    if type(fld) == model:
-                        blocked = True
-                        break
-                if fld in self.blocking_instances:
-                    blocked = True
-                if blocked:
-                    return_list.append(fld)
-                elif isinstance(fld, models.Model) and (fld.__class__, fld.pk) not in mark:
-                    return_list.extend(_get_all_related_object_recursively(fld, mark))
-            return return_list
-        mark = set([])
-        return _get_all_related_object_recursively(obj, mark)
+            pks_by_model = OrderedDict()
+            new_keys = set([])
+            for key in keys:
+                if key not in mark:
+                    mark.update([key])
+                    new_keys.update([key])
+                    pks_by_model.setdefault(key[0], []).append(key[1])
+            frontier = OrderedDict()
+            for model, pks in self._get_most_derived_pks(pks_by_model, chunk_size, using).items():
+                for pk in pks:
+                    if (model, pk) not in new_keys:
+                        if (model, pk) in mark:
+                            continue
+                        mark.update([(model, pk)])
+                    if pk not in included.setdefault(model, set()):
+                        included[model].add(pk)
+                        frontier.setdefault(model, []).append(pk)
+            return frontier
+
+        frontier = _visit((obj.__class__, obj.pk) for obj in objs)
+        while frontier:
+            keys = []
+            for model, pks in frontier.items():
+                if pruned_edges is not None:
+                    for field_name in self._ignored_field_names.get(model, ()):
+                        pruned_edges[(model._meta.label, field_name, "ignored_fields")] += len(pks)
+                for field, field_name in self._get_model_plan(model).relations:
+                    for key in self._get_related_pks_of_field(field, field_name, model, pks, chunk_size, using):
+                        if (key[0] in self._blocking_models or
+                                (key[0]._meta.concrete_model, key[1]) in self._blocking_instances):
+                            included.setdefault(key[0], set()).add(key[1])
+                            if pruned_edges is not None:
+                                rule = "blocking_models" if key[0] in self._blocking_models else "blocking_instances"
+                                pruned_edges[(model._meta.label, field_name, rule)] += 1
+                            continue
+                        keys.append(key)
+            frontier = _visit(keys)
+        return OrderedDict((model, sorted(pks)) for model, pks in included.items())
 
-    def clone(self, obj, editor=None):
+    def _get_most_derived_pks(self, pks_by_model, chunk_size, using=None):
         """
-        make copy of every objects that are related to one object
+        go down through parent links to the most derived model of every key
+        every subclass is checked with one query per chunk of keys
         """
+        derived = OrderedDict()
+        pending = deque(pks_by_model.items())
+        while pending:
+            model, pks = pending.popleft()
+            remaining = set(pks)
+            for field in self._get_model_plan(model).parent_links:
+                if not remaining:
+                    break
+                manager = field.related_model._base_manager.db_manager(using)
+                found = set()
+                for chunk in chunks(sorted(remaining), chunk_size):
+                    found.update(manager.filter(pk__in=chunk).values_list("pk", flat=True))
+                if found:
+                    remaining -= found
+                    pending.append((field.related_model, list(found)))
+            if remaining:
+                derived.setdefault(model, []).extend(pk for pk in pks if pk in remaining)
+        return derived
 
-        old_to_new_objects_map = self.ignored_instances.copy()
-        new_to_old_objects_map = {b: a for a, b in old_to_new_objects_map.items()}
+    def _get_related_pks_of_field(self, field, field_name, model, pks, chunk_size, using=None):
+        """
+        fetch (model, pk) of the objects related to some objects of
+        the same model through one relation field
+        """
+        parent_link = field.one_to_one and getattr(field.remote_field, "parent_link", False)
+        if field.concrete and parent_link:
+            # The parent row is a part of the same object.
+            return []
+        if field.concrete and (field.many_to_one or field.one_to_one) and field.target_field.primary_key:
+            manager = model._base_manager.db_manager(using)
+            lookup, values_name = "pk__in", field.attname
+        elif field.concrete and (field.many_to_one or field.one_to_one or field.many_to_many):
+            manager = field.related_model._base_manager.db_manager(using)
+            lookup, values_name = field.related_query_name() + "__pk__in", "pk"
+            if field.many_to_many:
+                manager = field.related_model._default_manager.db_manager(using)
+        elif field.auto_created and hasattr(field, "field"):
+            manager = field.related_model._default_manager.db_manager(using)
+            lookup, values_name = field.field.name + "__pk__in", "pk"
+        else:
+            # Relations that can't be expressed as a query are
+            # followed through the objects of every chunk.
+            keys = []
+            objects = model._base_manager.db_manager(using)
+            for chunk in chunks(pks, chunk_size):
+                for obj in objects.filter(pk__in=chunk):
+                    for related_object in self._get_related_objects_of_object(field, field_name, obj):
+                        keys.append((related_object.__class__, related_object.pk))
+            return keys
 
-        old_objects = self.get_all_related_object(obj)
+        values = set()
+        for chunk in chunks(pks, chunk_size):
+            values.update(manager.filter(**{lookup: chunk}).values_list(values_name, flat=True))
+        values.discard(None)
+        return [(field.related_model, value) for value in values]
 
-        save_queue = []
-        for old_object in old_objects:
+    def _stream_save(self, queue_by_model, queued, pk_map, editor, chunk_size, batch_size, break_cycles,
+                     sql_copier=None, source=None, target=None):
+        """
+        copy the queued rows model by model, in the order of their non-null
+        foreign keys, loading and inserting chunk_size rows at a time
+        with a sql_copier the models that allow it are copied inside the database
+        returns the old pks of the rows whose references were saved
+        before their targets, per (model, field)
+        """
+        deferred_relations = OrderedDict()
+        dependencies = self._get_model_dependencies(queue_by_model)
+        done = set()
+        for model in _topological_sort(list(queue_by_model), dependencies, break_cycles):
+            if sql_copier is not None and self._can_copy_in_sql(model, queue_by_model, done):
+                self._sql_save_model(model, queue_by_model[model], pk_map, sql_copier, chunk_size)
+            else:
+                self._stream_save_model(model, queue_by_model[model], queued, pk_map, editor, chunk_size,
+                                        batch_size, deferred_relations, self.last_stats, source, target,
+                                        break_cycles)
+            done.add(model)
+        if sql_copier is not None:
+            # A failed clone doesn't drop the table, its transaction is
+            # aborted and rolling it back removes the table too.
+            sql_copier.close()
 
-            ignored = False
-            match = None
+        self.last_stats.deferred_relations += sum(len(old_pks) for old_pks in deferred_relations.values())
+        return deferred_relations
 
-            if old_object in self.ignored_instances:
-                ignored = True
-                match = self.ignored_instances[old_object]
+    def _parallel_save(self, queue_by_model, queued, pk_map, editor, chunk_size, batch_size, workers, source=None,
+                       target=None):
+        """
+        copy the queued rows like _stream_save, but copy the models of every
+        dependency level at the same time in a pool of worker threads
+        models with many rows are split into shards of consecutive pks
+        every worker uses its own connection and commits its own shard, and
+        the pk maps of the workers are merged before the next level starts
+        """
+        dependencies = self._get_model_dependencies(queue_by_model)
+        deferred_relations = OrderedDict()
+        if any(connections[target or router.db_for_write(model)].vendor == "sqlite" for model in queue_by_model):
+            # SQLite locks the whole database for every write, so
+            # the shards are copied one after the other.
+            pool = ThreadPool(1)
+        else:
+            pool = ThreadPool(workers)
+        try:
+            for level in _split_levels(list(queue_by_model), dependencies):
+                tasks = []
+                for model in level:
+                    pks = queue_by_model[model]
+                    if self._get_model_plan(model).self_references:
+                        # The rows refer to each other, so they're copied in order by one worker.
+                        tasks.append((model, pks))
+                        continue
+                    for shard in chunks(pks, max(chunk_size, -(-len(pks) // workers))):
+                        tasks.append((model, shard))
+                results = pool.map(lambda task: self._save_shard(task[0], task[1], queued, pk_map, editor,
+                                                                 chunk_size, batch_size, source, target), tasks)
+                for shard_map, shard_deferred_relations, stats in results:
+                    pk_map.update(shard_map)
+                    for key, old_pks in shard_deferred_relations.items():
+                        deferred_relations.setdefault(key, []).extend(old_pks)
+                    self.last_stats.objects.update(stats.objects)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.last_stats.deferred_relations += sum(len(old_pks) for old_pks in deferred_relations.values())
+        return deferred_relations
+
+    def _save_shard(self, model, pks, queued, pk_map, editor, chunk_size, batch_size, source=None, target=None):
+        """
+        copy some rows of a model in a worker thread, in a transaction of its own
+        returns the new part of the pk map, the deferred relations and the statistics
+        """
+        shard_map = PkMap(parent=pk_map)
+        deferred_relations = OrderedDict()
+        stats = CloneStats()
+        try:
+            with transaction.atomic(using=target or router.db_for_write(model)):
+                self._stream_save_model(model, pks, queued, shard_map, editor, chunk_size, batch_size,
+                                        deferred_relations, stats, source, target)
+        finally:
+            # Connections belong to the thread.
+            connections.close_all()
+        return shard_map, deferred_relations, stats
+
+    def _can_copy_in_sql(self, model, queue_by_model, done):
+        """
+        whether the rows of a model only need a new primary key and mapped
+        foreign keys, and all of their targets have been copied already
+        the keys are mapped in a table of integers, so they all have to be integers
+        """
+        plan = self._get_model_plan(model)
+        if model._meta.parents or not isinstance(model._meta.pk, AutoField) or list(self._get_unique_checks(model)):
+            return False
+        for field in plan.foreign_keys:
+            if not field.target_field.primary_key or not _has_integer_pk(field.related_model):
+                return False
+            for other_model in queue_by_model:
+                if field.related_model in self._get_model_plan(other_model).models and other_model not in done:
+                    return False
+        return True
+
+    def _sql_save_model(self, model, pks, pk_map, sql_copier, chunk_size):
+        """
+        copy the queued rows of one model inside the database
+        """
+        plan = self._get_model_plan(model)
+        for chunk in chunks(pks, chunk_size):
+            new_pks = sql_copier.copy(model, chunk, pk_map, plan.foreign_keys)
+            if self._written_references is not None and plan.foreign_keys:
+                # The database maps the foreign keys, so they're only read for the discovery cache.
+                rows = model._base_manager.db_manager(sql_copier.using).filter(pk__in=chunk).values_list(
+                    *[field.attname for field in plan.foreign_keys])
+                for row in rows:
+                    for field, value in zip(plan.foreign_keys, row):
+                        self._map_related_value(field, value, pk_map)
+            for old_pk, new_pk in zip(chunk, new_pks):
+                pk_map.add(model, old_pk, new_pk)
+            self.last_stats.objects[model._meta.label] += len(chunk)
+
+    def _stream_save_model(self, model, pks, queued, pk_map, editor, chunk_size, batch_size, deferred_relations,
+                           stats, source=None, target=None, break_cycles=False):
+        """
+        copy the queued rows of one model, chunk_size rows at a time
+        rows that refer to rows of the same model are copied after them
+        rows are read from source and written to target, both default to the routers
+        """
+        plan = self._get_model_plan(model)
+        manager = model._default_manager.db_manager(target or router.db_for_write(model))
+        old_objects = model._base_manager.db_manager(source)
+        levels = self._split_self_references(model, pks, chunk_size, break_cycles, source)
+        for chunk in (chunk for level in levels for chunk in chunks(level, chunk_size)):
+            with stats.phase("copy"):
+                instances = []
+                pending_keys = {}
+                chunk_objects = list(old_objects.filter(pk__in=chunk))
+                new_objects = []
+                for old_object in chunk_objects:
+                    new_object = copy(old_object)
+                    new_object.pk = None
+                    new_objects.append(new_object)
+                new_objects = self._edit_copies(model, new_objects, editor)
+                for new_object, old_object in zip(new_objects, chunk_objects):
+                    instance = model(**self._get_copy_kwargs(new_object))
+                    for field in self._set_foreign_keys(instance, old_object, queued, pk_map, plan.foreign_keys):
+                        deferred_relations.setdefault((model, field), []).append(old_object.pk)
+                        pending_keys[(id(instance), field)] = self._get_related_key(field, old_object)
+                    instances.append((instance, old_object))
+
+            with stats.phase("validation"):
+                def get_value(instance, field):
+                    if (id(instance), field) in pending_keys:
+                        return Pending(pending_keys[(id(instance), field)])
+                    return getattr(instance, field.attname)
+
+                old_objects_by_id = dict((id(instance), old_object) for instance, old_object in instances)
+                conflicts = find_unique_conflicts([instance for instance, old_object in instances], get_value,
+                                                  manager.db)
+                if conflicts:
+                    raise CloneUniqueError([(old_objects_by_id[id(instance)], field_names)
+                                            for instance, model_class, field_names in conflicts])
+
+            if model._meta.parents or not _can_return_bulk_pks(model, manager.db):
+                for instance, old_object in instances:
+                    instance.save(force_insert=True, using=manager.db)
             else:
-                for model in self.ignored_models:
-                    if type(old_object) == model:
-                        ignored = True
-                        match = old_object
-                        break
+                manager.bulk_create([instance for instance, old_object in instances], batch_size=batch_size)
+            for instance, old_object in instances:
+                self._add_to_key_map(pk_map, old_object, instance)
+            stats.objects[model._meta.label] += len(instances)
+
+    def _stream_update_relations(self, model, field, old_pks, pk_map, chunk_size, batch_size, source=None,
+                                 target=None):
+        """
+        patch a foreign key of the copies whose target was inserted after them
+        """
+        manager = model._base_manager.db_manager(source)
+        for chunk in chunks(old_pks, chunk_size):
+            values = {}
+            old_objects = manager.filter(pk__in=chunk).only(model._meta.pk.attname, field.attname)
+            for old_object in old_objects:
+                values[pk_map.get(model, old_object.pk)] = self._get_new_related_value(field, old_object, pk_map)
+            self._bulk_update(model, field, values, batch_size, target)
+
+    def _get_save_queue(self, old_objects, pk_map, editor=None):
+        """
+        make unsaved copies of the objects that aren't ignored
+        returns (copy, old object) of the objects to save and
+        (match, old object) of the ignored ones
+        """
+        save_queue = []
+        ignored = []
+        for old_object in old_objects:
 
-            if not ignored:
+            match = self._ignored_instances.get(self._get_instance_key(old_object))
+            if match is None and type(old_object) in self._ignored_models:
+                match = old_object
+
+            if match is None:
                 new_object = copy(old_object)
                 new_object.pk = None
-                if editor is not None and callable(editor):
-                    new_object = editor(new_object)
-                save_queue.append((new_object, old_object, -1))
+                save_queue.append((new_object, old_object))
             else:
-                old_to_new_objects_map[old_object] = match
+                ignored.append((match, old_object))
+                self._add_to_key_map(pk_map, old_object, match)
+                self.last_stats.ignored_objects[old_object._meta.label] += 1
 
+        indexes_by_model = OrderedDict()
+        for index, (new_object, old_object) in enumerate(save_queue):
+            indexes_by_model.setdefault(new_object.__class__, []).append(index)
+        for model, indexes in indexes_by_model.items():
+            new_objects = self._edit_copies(model, [save_queue[index][0] for index in indexes], editor)
+            for index, new_object in zip(indexes, new_objects):
+                save_queue[index] = (new_object, save_queue[index][1])
+        return save_queue, ignored
 
-        new_objects = []
+    @staticmethod
+    def _edit_copies(model, new_objects, editor):
+        """
+        pass the unsaved copies of one model through the editor of a clone
+        """
+        if isinstance(editor, BatchEditor):
+            edited = list(editor.edit(model, new_objects))
+            if len(edited) != len(new_objects):
+                raise ValueError("A batch editor has to return one object for every copy")
+            return edited
+        if editor is not None and callable(editor):
+            return [editor(new_object) for new_object in new_objects]
+        return new_objects
 
-        while len(save_queue) > 0:
+    def _validate_unique(self, save_queue, queued, pk_map):
+        """
+        check the unique constraints of all copies before saving any of them
+        and report every conflict at once
+        """
+        old_objects = dict((id(new_object), old_object) for new_object, old_object in save_queue)
 
-            new_object, old_object, last_time_length = save_queue.pop(0)
-            if last_time_length == len(new_objects):
-                raise ValueError("Unable to clone due to unique and not-null fields. "
-                                 "Use an editor to modify unique values before saving")
+        def get_value(new_object, field):
+            if field not in self._get_model_plan(new_object.__class__).foreign_keys:
+                return getattr(new_object, field.attname)
+            # Foreign keys are saved pointing to the copies.
+            old_object = old_objects[id(new_object)]
+            key = self._get_related_key(field, old_object)
+            if key in queued:
+                return Pending(key)
+            return self._get_new_related_value(field, old_object, pk_map)
 
-            # Updating the relations that their match has already been saved
+        # Don't use full clean here because
+        # it might have not been used on old object
+        conflicts = find_unique_conflicts([new_object for new_object, old_object in save_queue], get_value)
+        if conflicts:
+            raise CloneUniqueError([(old_objects[id(new_object)], field_names)
+                                    for new_object, model_class, field_names in conflicts])
 
-            try:
-                self._update_relations(new_object, old_object, old_to_new_objects_map, lazy=True)
-                # Don't use full clean here because
-                # it might have not been used on old object
-                new_object.validate_unique()
-            except ValidationError as e:
-                save_queue.append((new_object, old_object, len(new_objects)))
-                continue
+    def _copy_many_to_many(self, pks_by_model, queued, pk_map, chunk_size, batch_size=None, source=None,
+                           target=None):
+        """
+        copy the rows of the through tables of many-to-many fields
+        the rows of every chunk of copied objects are read with one query
+        from source and written with one bulk_create to target
+        """
+        for model, pks in pks_by_model.items():
+            for field in self._get_model_plan(model).many_to_many_fields:
+                through = field.remote_field.through
+                through_plan = self._get_model_plan(through)
+                source_name = through._meta.get_field(field.m2m_field_name()).attname
+                target_name = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                target_model = field.related_model
+                manager = through._default_manager.db_manager(target)
+                old_rows = through._default_manager.db_manager(source)
+                for chunk in chunks(pks, chunk_size):
+                    rows = []
+                    values = old_rows.filter(**{source_name + "__in": chunk}).values(
+                        through._meta.pk.attname, *through_plan.copy_fields)
+                    for row in values:
+                        if (through, row.pop(through._meta.pk.attname)) in pk_map:
+                            # Rows of explicit through models are usually
+                            # reachable from both ends and are cloned as objects.
+                            continue
+                        old_target = row[target_name]
+                        for fk in through_plan.foreign_keys:
+                            row[fk.attname] = self._map_related_value(fk, row[fk.attname], pk_map)
+                        rows.append(row)
+                        if field.remote_field.symmetrical and (target_model, old_target) not in queued:
+                            # The reverse row is only read when the target is copied too.
+                            rows.append({source_name: row[target_name], target_name: row[source_name]})
+                    if rows:
+                        manager.bulk_create([through(**row) for row in rows], batch_size=batch_size)
+                        self.last_stats.objects[through._meta.label] += len(rows)
 
-            new_object_dict = {}
-            for field in new_object._meta.get_fields():
-                if field.auto_created:
-                    continue
-                if field.is_relation:
-                    parent_link = field.one_to_one and getattr(field.remote_field, "parent_link", False)
-                    if parent_link or field.many_to_many or field.one_to_many:
-                        continue
-                new_object_dict[field.name] = getattr(new_object, field.name, None)
+    def _save(self, save_queue, queued, pk_map, break_cycles=False):
+        """
+        insert new objects one by one, each one after the objects
+        that its non-null foreign keys point to
+        returns (new object, old object) of the saved objects
+        """
+        dependencies = {}
+        for index, (new_object, old_object) in enumerate(save_queue):
+            dependencies[index] = set()
+            for field in self._get_model_plan(new_object.__class__).foreign_keys:
+                key = self._get_related_key(field, old_object)
+                if not field.null and key in queued:
+                    dependencies[index].add(queued.get(*key))
 
+        saved = []
+        deferred_relations = []
+        for index in self._sort_save_queue(save_queue, dependencies, break_cycles):
+            new_object, old_object = save_queue[index]
+            deferred_fields = self._set_foreign_keys(new_object, old_object, queued, pk_map,
+                                                     self._get_model_plan(new_object.__class__).foreign_keys)
+
+            new_object_dict = self._get_copy_kwargs(new_object)
             new_object = new_object.__class__.objects.create(**new_object_dict)
-            new_objects.append(new_object)
-            old_to_new_objects_map[old_object] = new_object
-            new_to_old_objects_map[new_object] = old_object
+            self.last_stats.objects[new_object._meta.label] += 1
+            saved.append((new_object, old_object))
+            self._add_to_key_map(pk_map, old_object, new_object)
+            if deferred_fields:
+                deferred_relations.append((new_object, old_object, deferred_fields))
+                self.last_stats.deferred_relations += len(deferred_fields)
 
         # All objects have been saved now. So we have to update
-        # all relations that weren't updated previously.
-        for new_object in new_objects:
-            self._update_relations(new_object, new_to_old_objects_map[new_object], old_to_new_objects_map)
-            new_object.save()
-
-        # Many-to-many relations
-        for new_object in new_objects:
-            for field in new_object._meta.get_fields():
-                if field.is_relation and field.many_to_many and field.auto_created is False:
-                    for fld in getattr(new_to_old_objects_map[new_object], field.name).all():
-                        mapped_fld = old_to_new_objects_map.get(fld, fld)
-                        current_field = getattr(new_object, field.name)
-                        if mapped_fld not in current_field.all():
-                            current_field.add(mapped_fld)
-            new_object.save()
-        return old_to_new_objects_map[obj]
-
-    def _update_relations(self, new_object, old_object, old_to_new_objects_map, lazy=False):
-        for field in new_object._meta.get_fields():
-            if field.is_relation and not field.auto_created and (field.many_to_one or field.one_to_one):
-                parent_link = field.one_to_one and getattr(field.remote_field, "parent_link", False)
-                if parent_link:
-                    continue
-                field_value = getattr(old_object, field.name, None)
+        # the relations that weren't updated previously.
+        with self.last_stats.phase("relations"):
+            for new_object, old_object, fields in deferred_relations:
+                self._update_relations(new_object, old_object, pk_map, fields)
+                new_object.save(update_fields=[field.name for field in fields])
 
-                mapped_value = old_to_new_objects_map.get(field_value, field_value)
-                if lazy:
-                    try:
-                        setattr(new_object, field.name, None)
-                    except ValueError:
-                        setattr(new_object, field.name, mapped_value)
+        return saved
+
+    @staticmethod
+    def _sort_save_queue(save_queue, dependencies, break_cycles=False):
+        """
+        order the indexes of a save queue by their dependencies
+        and report cycles with the old objects
+        """
+        try:
+            return _topological_sort(list(range(len(save_queue))), dependencies, break_cycles)
+        except CloneCycleError as error:
+            raise CloneCycleError([save_queue[index][1] for index in error.cycle])
+
+    def _bulk_save(self, save_queue, queued, pk_map, batch_size=None, break_cycles=False, using=None):
+        """
+        insert new objects model by model, in the order of their
+        non-null foreign keys, and patch nullable back-references afterwards
+        the objects are written to using, which defaults to the routers
+        returns (new object, old object) of the saved objects
+        """
+        queue_by_model = OrderedDict()
+        for new_object, old_object in save_queue:
+            queue_by_model.setdefault(new_object.__class__, []).append((new_object, old_object))
+
+        saved = []
+        back_references = []
+        dependencies = self._get_model_dependencies(queue_by_model)
+        for model in _topological_sort(list(queue_by_model), dependencies, break_cycles):
+            rows = queue_by_model[model]
+            levels = self._get_self_reference_levels(model, [old_object for new_object, old_object in rows],
+                                                     break_cycles)
+            for level in levels:
+                instances = []
+                for new_object, old_object in (rows[index] for index in level):
+                    new_object_dict = self._get_copy_kwargs(new_object)
+                    instance = model(**new_object_dict)
+                    for field in self._set_foreign_keys(instance, old_object, queued, pk_map,
+                                                        self._get_model_plan(model).foreign_keys):
+                        back_references.append((instance, old_object, field))
+                    instances.append((instance, old_object))
+
+                manager = model._default_manager.db_manager(using or router.db_for_write(model))
+                if model._meta.parents or not _can_return_bulk_pks(model, manager.db):
+                    # Multi-table inheritance can't use bulk_create and
+                    # auto-increment keys are needed to map the new objects.
+                    for instance, old_object in instances:
+                        instance.save(force_insert=True, using=manager.db)
                 else:
-                    setattr(new_object, field.name, mapped_value)
+                    manager.bulk_create([instance for instance, old_object in instances], batch_size=batch_size)
+
+                self.last_stats.objects[model._meta.label] += len(instances)
+                for instance, old_object in instances:
+                    saved.append((instance, old_object))
+                    self._add_to_key_map(pk_map, old_object, instance)
+
+        # Every object has been inserted now, so the references to
+        # objects that were inserted later can be updated in bulk.
+        self.last_stats.deferred_relations += len(back_references)
+        with self.last_stats.phase("relations"):
+            updates = OrderedDict()
+            for instance, old_object, field in back_references:
+                self._update_relations(instance, old_object, pk_map, [field])
+                updates.setdefault((instance.__class__, field), {})[instance.pk] = getattr(instance, field.attname)
+            for (model, field), values in updates.items():
+                self._bulk_update(model, field, values, batch_size, using)
+
+        return saved
+
+    def _get_model_dependencies(self, models):
+        """
+        the models that rows of every model can only be inserted after,
+        because its non-null foreign keys point to them
+        references of a model to itself are left to the order of its rows
+        """
+        dependencies = {}
+        for model in models:
+            dependencies[model] = set()
+            for field in self._get_model_plan(model).foreign_keys:
+                if field.null:
+                    continue
+                for other_model in models:
+                    if other_model is not model and field.related_model in self._get_model_plan(other_model).models:
+                        dependencies[model].add(other_model)
+        return dependencies
+
+    def _get_self_reference_levels(self, model, old_objects, break_cycles=False):
+        """
+        split the indexes of old objects of one model into levels that can be
+        inserted one after the other, because the not-null foreign keys of
+        every object only point to objects of earlier levels
+        """
+        fields = self._get_model_plan(model).self_references
+        if not fields:
+            return [list(range(len(old_objects)))]
+        indexes = {}
+        for index, old_object in enumerate(old_objects):
+            for field in fields:
+                indexes[(field, getattr(old_object, field.target_field.attname))] = index
+        dependencies = {}
+        for index, old_object in enumerate(old_objects):
+            keys = [(field, getattr(old_object, field.attname)) for field in fields]
+            dependencies[index] = set(indexes[key] for key in keys if key in indexes)
+        try:
+            return _split_levels(list(range(len(old_objects))), dependencies, break_cycles)
+        except CloneCycleError as error:
+            raise CloneCycleError([old_objects[index] for index in error.cycle])
+
+    def _split_self_references(self, model, pks, chunk_size, break_cycles=False, using=None):
+        """
+        split the pks of one model like _get_self_reference_levels, loading
+        only the fields that the rows refer to each other with
+        """
+        fields = self._get_model_plan(model).self_references
+        if not fields:
+            return [pks]
+        names = set()
+        for field in fields:
+            names.update([field.name, field.target_field.name])
+        old_objects = []
+        for chunk in chunks(pks, chunk_size):
+            old_objects.extend(model._base_manager.db_manager(using).filter(pk__in=chunk).only(*names))
+        return [[old_objects[index].pk for index in level]
+                for level in self._get_self_reference_levels(model, old_objects, break_cycles)]
+
+    @staticmethod
+    def _bulk_update(model, field, values, batch_size=None, using=None):
+        """
+        set a field of many rows to different values, one query per batch
+        """
+        manager = model._base_manager.db_manager(using)
+        for pks in chunks(list(values), batch_size or get_in_list_size(manager.db)):
+            cases = [When(pk=pk, then=Value(values[pk])) for pk in pks]
+            manager.filter(pk__in=pks).update(**{
+                field.attname: Case(*cases, output_field=field.target_field if field.is_relation else field)
+            })
+
+    def _add_to_key_map(self, key_map, old_object, new_object):
+        """
+        map every key of an old object to the matching value of its copy
+        """
+        for key_model, value, attname in self._get_object_keys(old_object):
+            key_map.add(key_model, value, getattr(new_object, attname))
+
+    def _get_object_keys(self, obj):
+        """
+        (key model, value, attname) of every key that foreign keys can use to
+        refer to an object: its pk under its own model and all of its parents,
+        and the other fields that foreign keys point to
+        """
+        for model in self._get_model_plan(obj.__class__).models:
+            yield model, obj.pk, "pk"
+            for attname in self._get_model_plan(model).referenced_fields:
+                value = getattr(obj, attname)
+                if value is not None:
+                    yield (model, attname), value, attname
+
+    @staticmethod
+    def _get_key_model(field):
+        """
+        model part of the keys that a foreign key refers to objects with
+        """
+        if field.target_field.primary_key:
+            return field.related_model
+        return field.related_model, field.target_field.attname
+
+    def _get_related_key(self, field, old_object):
+        """
+        key of the object that a foreign key of an old object points to
+        it only reads the raw value of the foreign key
+        """
+        value = getattr(old_object, field.attname)
+        if value is None:
+            return None
+        return self._get_key_model(field), value
+
+    def _map_related_value(self, field, value, pk_map):
+        """
+        map a raw foreign key value to the matching value of the copy of its target
+        """
+        if value is None:
+            return value
+        key_model = self._get_key_model(field)
+        new_value = pk_map.get(key_model, value, value)
+        if self._written_references is not None:
+            self._written_references.add((key_model, new_value))
+        return new_value
+
+    def _get_new_related_value(self, field, old_object, pk_map):
+        """
+        map the value of a foreign key of an old object to the matching new object
+        """
+        return self._map_related_value(field, getattr(old_object, field.attname), pk_map)
+
+    def _get_copy_kwargs(self, new_object):
+        """
+        values of the fields that are used to create a copy of an object
+        """
+        return dict((name, getattr(new_object, name, None))
+                    for name in self._get_model_plan(new_object.__class__).copy_fields)
+
+    def _set_foreign_keys(self, new_object, old_object, queued, pk_map, fields):
+        """
+        point foreign keys of a new object to the copies of their old targets,
+        and return the fields whose targets are copied but haven't been
+        inserted yet, so they can be updated afterwards
+        """
+        deferred_fields = []
+        for field in fields:
+            key = self._get_related_key(field, old_object)
+            if key in queued and key not in pk_map:
+                # Not-null references only get here when a cycle is broken and keep the old value.
+                deferred_fields.append(field)
+                setattr(new_object, field.attname, None if field.null else getattr(old_object, field.attname))
+            else:
+                self._update_relations(new_object, old_object, pk_map, [field])
+        return deferred_fields
+
+    def _update_relations(self, new_object, old_object, pk_map, fields):
+        """
+        point foreign keys of a new object to the copies of their old targets
+        """
+        for field in fields:
+            setattr(new_object, field.attname, self._get_new_related_value(field, old_object, pk_map))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from django_clone.clone import Cloner
+
+
+class Command(BaseCommand):
+    help = ("Clone an object with everything that is related to it. The progress is saved to a checkpoint "
+            "file after every chunk, and running the command again with the same checkpoint resumes it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="label of the model of the object, like app_label.ModelName")
+        parser.add_argument("pk", help="primary key of the object")
+        parser.add_argument("--checkpoint", required=True, help="file that the progress is saved to")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="rows that are copied at a time")
+        parser.add_argument("--batch-size", type=int, default=None, help="rows that are inserted per query")
+        parser.add_argument("--ignore-model", action="append", default=[], dest="ignored_models",
+                            help="label of a model whose objects are kept instead of copied")
+        parser.add_argument("--block-model", action="append", default=[], dest="blocking_models",
+                            help="label of a model whose relations aren't followed")
+        parser.add_argument("--ignore-field", action="append", default=[], dest="ignored_fields",
+                            help="app_label.ModelName.field of a relation that isn't followed")
+        parser.add_argument("--block-instance", action="append", default=[], dest="blocking_instances",
+                            help="app_label.ModelName:pk of an object whose relations aren't followed")
+
+    def handle(self, *args, **options):
+        model = self._get_model(options["model"])
+        obj = self._get_object(model, options["pk"])
+        ignored_fields = []
+        for name in options["ignored_fields"]:
+            label, _, field_name = name.rpartition(".")
+            ignored_fields.append((self._get_model(label)._meta.label, field_name))
+        blocking_instances = []
+        for name in options["blocking_instances"]:
+            label, _, pk = name.rpartition(":")
+            blocking_instances.append(self._get_object(self._get_model(label), pk))
+
+        cloner = Cloner(ignored_models=[self._get_model(label)._meta.label for label in options["ignored_models"]],
+                        blocking_models=[self._get_model(label)._meta.label for label in options["blocking_models"]],
+                        ignored_fields=ignored_fields,
+                        blocking_instances=blocking_instances)
+
+        def progress(label, done, total, rate):
+            self.stdout.write("%s: %d/%d rows, %.1f rows/s" % (label, done, total, rate))
+
+        new_object = cloner.clone_resumable(obj, options["checkpoint"], chunk_size=options["chunk_size"],
+                                            batch_size=options["batch_size"], progress=progress)
+        stats = cloner.last_stats
+        self.stdout.write("Cloned %s %s to %s: %d objects in %.2fs" % (
+            model._meta.label, obj.pk, new_object.pk, sum(stats.objects.values()), stats.time))
+
+    @staticmethod
+    def _get_model(label):
+        try:
+            return apps.get_model(label)
+        except (LookupError, ValueError):
+            raise CommandError("Unknown model %r" % label)
+
+    @staticmethod
+    def _get_object(model, pk):
+        try:
+            return model._base_manager.get(pk=pk)
+        except (model.DoesNotExist, ValueError):
+            raise CommandError("%s %r does not exist" % (model._meta.label, pk))
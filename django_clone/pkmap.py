@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from array import array
+from bisect import bisect_left
+import numbers
+
+
+class ModelPkMap(object):
+    """
+    old pk -> new pk mapping of one model
+    integer keys are kept in two sorted arrays (16 bytes per entry), new
+    entries that don't come in order wait in a small dict until it's merged
+    other keys (uuids, strings) are kept in a plain dict
+    """
+
+    def __init__(self):
+        self._old = array("q")
+        self._new = array("q")
+        self._tail = {}
+        self._others = None
+
+    def add(self, old_pk, new_pk):
+        if self._others is None and _is_integer(old_pk) and _is_integer(new_pk):
+            if not self._tail and (not self._old or self._old[-1] < old_pk):
+                self._old.append(old_pk)
+                self._new.append(new_pk)
+                return
+            self._tail[old_pk] = new_pk
+            if len(self._tail) > max(1024, len(self._old)):
+                self._merge()
+            return
+        if self._others is None:
+            # Keys that don't fit in the arrays switch the map to a dict.
+            self._others = dict(self.items())
+            self._old, self._new, self._tail = array("q"), array("q"), {}
+        self._others[old_pk] = new_pk
+
+    def get(self, old_pk, default=None):
+        if self._others is not None:
+            return self._others.get(old_pk, default)
+        if old_pk in self._tail:
+            return self._tail[old_pk]
+        if not _is_integer(old_pk):
+            return default
+        index = bisect_left(self._old, old_pk)
+        if index < len(self._old) and self._old[index] == old_pk:
+            return self._new[index]
+        return default
+
+    def __contains__(self, old_pk):
+        return self.get(old_pk, _missing) is not _missing
+
+    def __len__(self):
+        if self._others is not None:
+            return len(self._others)
+        return len(self._old) + len(self._tail)
+
+    def items(self):
+        if self._others is not None:
+            return list(self._others.items())
+        self._merge()
+        return list(zip(self._old, self._new))
+
+    def old_pks(self):
+        return [old_pk for old_pk, new_pk in self.items()]
+
+    def _merge(self):
+        if not self._tail:
+            return
+        merged = dict(zip(self._old, self._new))
+        merged.update(self._tail)
+        old_pks = sorted(merged)
+        self._old = array("q", old_pks)
+        self._new = array("q", (merged[old_pk] for old_pk in old_pks))
+        self._tail = {}
+
+
+class PkMap(object):
+    """
+    old pk -> new pk mapping of many models
+    keys that aren't found are looked up in the parent map, if there is one,
+    so a worker can add to its own map while it reads a shared one
+    """
+
+    def __init__(self, parent=None):
+        self._maps = {}
+        self.parent = parent
+
+    def add(self, model, old_pk, new_pk):
+        model_map = self._maps.get(model)
+        if model_map is None:
+            model_map = self._maps[model] = ModelPkMap()
+        model_map.add(old_pk, new_pk)
+
+    def get(self, model, old_pk, default=None):
+        model_map = self._maps.get(model)
+        new_pk = _missing if model_map is None else model_map.get(old_pk, _missing)
+        if new_pk is not _missing:
+            return new_pk
+        if self.parent is not None:
+            return self.parent.get(model, old_pk, default)
+        return default
+
+    def __contains__(self, key):
+        if key is None:
+            return False
+        return self.get(key[0], key[1], _missing) is not _missing
+
+    def update(self, other):
+        """
+        add the entries of another map, but not of its parent
+        """
+        for model, model_map in other._maps.items():
+            for old_pk, new_pk in model_map.items():
+                self.add(model, old_pk, new_pk)
+
+    def __len__(self):
+        return sum(len(model_map) for model_map in self._maps.values())
+
+    def __getitem__(self, model):
+        return self._maps.get(model) or ModelPkMap()
+
+    def models(self):
+        return list(self._maps)
+
+
+_missing = object()
+
+
+def _is_integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
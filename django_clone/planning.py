@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import Counter
+
+
+class ClonePlan(object):
+    """
+    what a clone would do, found without writing or loading full rows
+    """
+
+    def __init__(self):
+        # Objects that would be copied or ignored per model label.
+        self.objects = Counter()
+        self.ignored_objects = Counter()
+        # Model labels in the order they would be inserted.
+        self.order = []
+        # Model labels of a cycle of not-null foreign keys, or (model label, pk)
+        # of the rows of a cycle of foreign keys of a model to itself,
+        # which can only be cloned with deferred constraints.
+        self.cycle = None
+        # Relations that aren't followed per (model label, field name, rule),
+        # with the number of objects they are skipped for.
+        self.pruned_edges = Counter()
+        # Copies that would keep an existing unique value per
+        # (model label, field names), unless an editor changes them.
+        self.unique_conflicts = Counter()
+        # Queries that a clone would run, not counting the updates
+        # of references that have to be deferred.
+        self.estimated_queries = 0
+        # Queries that making the plan took.
+        self.queries = 0
+
+    @property
+    def conflicts_likely(self):
+        return bool(self.unique_conflicts)
+
+    def as_dict(self):
+        """
+        plain representation that can be logged or shown before a clone
+        """
+        return {
+            "objects": dict(self.objects),
+            "ignored_objects": dict(self.ignored_objects),
+            "order": list(self.order),
+            "cycle": list(self.cycle) if self.cycle is not None else None,
+            "pruned_edges": [{"model": label, "field": field_name, "rule": rule, "objects": number}
+                             for (label, field_name, rule), number in self.pruned_edges.items()],
+            "unique_conflicts": [{"model": label, "fields": list(field_names), "objects": number}
+                                 for (label, field_names), number in self.unique_conflicts.items()],
+            "estimated_queries": self.estimated_queries,
+            "queries": self.queries,
+        }
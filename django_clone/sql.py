@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from django.db import connections
+
+from django_clone.utils import chunks, get_in_list_size
+
+
+MAP_TABLE = "django_clone_pk_map"
+
+
+def can_copy_in_sql(using):
+    """
+    whether rows can be copied inside a database
+    new primary keys are reserved before the rows are inserted, which needs
+    sequences or a database that only has one writer at a time
+    """
+    return connections[using].vendor in ("postgresql", "sqlite")
+
+
+class SqlCopier(object):
+    """
+    copy rows of a model inside the database with INSERT ... SELECT
+    old -> new primary keys are kept in a temporary table of integers, which is
+    joined once for the rows themselves and once for every foreign key
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.connection = connections[using]
+        # Number of entries of every key model that are in the table.
+        self._loaded = {}
+        self._created = False
+
+    def copy(self, model, old_pks, pk_map, foreign_keys):
+        """
+        copy the rows of some primary keys and return the new primary keys,
+        in the same order
+        foreign keys are mapped through pk_map, or keep their values
+        """
+        quote = self.connection.ops.quote_name
+        self._create()
+        for field in foreign_keys:
+            self._load(field.related_model, pk_map)
+
+        new_pks = self._reserve_pks(model, len(old_pks))
+        self._insert_entries(model, list(zip(old_pks, new_pks)))
+
+        columns, values, joins, params = [], [], [], []
+        for field in model._meta.concrete_fields:
+            columns.append(quote(field.column))
+            if field.primary_key:
+                values.append("m.new_id")
+            elif field in foreign_keys:
+                alias = "m%d" % len(joins)
+                joins.append("LEFT JOIN {map} {alias} ON {alias}.key_table = %s AND {alias}.old_id = s.{column}".format(
+                    map=quote(MAP_TABLE), alias=alias, column=quote(field.column)))
+                params.append(field.related_model._meta.db_table)
+                values.append("COALESCE({alias}.new_id, s.{column})".format(alias=alias, column=quote(field.column)))
+            else:
+                values.append("s.%s" % quote(field.column))
+        # Reserved keys only grow, so the new keys of the rows are the
+        # entries of the model between the first and last reserved key.
+        sql = ("INSERT INTO {table} ({columns}) SELECT {values} FROM {table} s {joins} "
+               "JOIN {map} m ON m.key_table = %s AND m.old_id = s.{pk} "
+               "WHERE m.new_id BETWEEN %s AND %s").format(
+            table=quote(model._meta.db_table), columns=", ".join(columns), values=", ".join(values),
+            joins=" ".join(joins), map=quote(MAP_TABLE), pk=quote(model._meta.pk.column))
+        params.extend([model._meta.db_table, min(new_pks), max(new_pks)])
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return new_pks
+
+    def close(self):
+        """
+        drop the temporary table, after a successful copy
+        """
+        if self._created:
+            with self.connection.cursor() as cursor:
+                cursor.execute("DROP TABLE %s" % self.connection.ops.quote_name(MAP_TABLE))
+            self._created = False
+            self._loaded = {}
+
+    def _create(self):
+        if self._created:
+            return
+        quote = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE %s (key_table varchar(255) NOT NULL, "
+                           "old_id bigint NOT NULL, new_id bigint NOT NULL)" % quote(MAP_TABLE))
+            cursor.execute("CREATE INDEX %s ON %s (key_table, old_id)" % (
+                quote(MAP_TABLE + "_key"), quote(MAP_TABLE)))
+        self._created = True
+
+    def _load(self, model, pk_map):
+        """
+        make the table hold all entries of a key model
+        """
+        model_map = pk_map[model]
+        if self._loaded.get(model._meta.db_table, 0) == len(model_map):
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE key_table = %%s" % self.connection.ops.quote_name(MAP_TABLE),
+                           [model._meta.db_table])
+        self._loaded[model._meta.db_table] = 0
+        self._insert_entries(model, model_map.items())
+
+    def _insert_entries(self, model, entries):
+        sql = "INSERT INTO %s (key_table, old_id, new_id) VALUES (%%s, %%s, %%s)" % (
+            self.connection.ops.quote_name(MAP_TABLE))
+        table = model._meta.db_table
+        with self.connection.cursor() as cursor:
+            for chunk in chunks(list(entries), get_in_list_size(self.using) or 1000):
+                cursor.executemany(sql, [(table, old_pk, new_pk) for old_pk, new_pk in chunk])
+        self._loaded[table] = self._loaded.get(table, 0) + len(entries)
+
+    def _reserve_pks(self, model, number):
+        """
+        reserve primary keys for new rows of a model
+        """
+        quote = self.connection.ops.quote_name
+        table, column = model._meta.db_table, model._meta.pk.column
+        with self.connection.cursor() as cursor:
+            if self.connection.vendor == "postgresql":
+                cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                               [table, column, number])
+                return [row[0] for row in cursor.fetchall()]
+            # SQLite only has one writer, and SQL copies always run in the
+            # transaction of the clone. AUTOINCREMENT tables also remember deleted keys.
+            cursor.execute("SELECT MAX(%s) FROM %s" % (quote(column), quote(table)))
+            last = cursor.fetchone()[0] or 0
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'")
+            if cursor.fetchone():
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+                row = cursor.fetchone()
+                last = max(last, row[0] if row else 0)
+        return list(range(last + 1, last + 1 + number))
+
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from time import time
+
+from django.db import connections
+
+
+class PhaseStats(object):
+    """
+    time and number of queries spent in one phase of a clone
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.queries = 0
+
+    def as_dict(self):
+        return {"time": self.time, "queries": self.queries}
+
+
+class CloneStats(object):
+    """
+    statistics of one clone
+    time and queries are accounted to the innermost running phase, so
+    the phases don't overlap and add up to the whole clone
+    queries are only counted when the clone is asked to
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.time = 0.0
+        self.queries = 0
+        self.counts_queries = False
+        # Copied and ignored objects per model label.
+        self.objects = Counter()
+        self.ignored_objects = Counter()
+        # Copies that a sync updated or deleted per model label.
+        self.updated_objects = Counter()
+        self.deleted_objects = Counter()
+        # References that were saved empty and fixed after their target was saved.
+        self.deferred_relations = 0
+
+        self._counter = None
+        self._current_phase = None
+        self._mark = None
+
+    @contextmanager
+    def collect(self, aliases=(), count_queries=False):
+        """
+        measure the whole clone, counting the queries on the given databases
+        """
+        self.counts_queries = count_queries
+        self._counter = _QueryCounter(aliases if count_queries else ())
+        start = time()
+        with self._counter:
+            self._mark = self._get_mark()
+            try:
+                yield self
+            finally:
+                self._switch_phase(None)
+                self.time += time() - start
+                self.queries += self._counter.count
+
+    @contextmanager
+    def phase(self, name):
+        """
+        account the time and queries of a block to a phase
+        """
+        previous_phase = self._current_phase
+        self._switch_phase(name)
+        try:
+            yield self.phases[name]
+        finally:
+            self._switch_phase(previous_phase)
+
+    def dominant_models(self, number=None):
+        """
+        (model label, copied objects) of the models with the most copies
+        """
+        return self.objects.most_common(number)
+
+    def as_dict(self):
+        """
+        plain representation that can be pushed to a metrics pipeline
+        """
+        return {
+            "time": self.time,
+            "queries": self.queries if self.counts_queries else None,
+            "phases": OrderedDict((name, phase.as_dict()) for name, phase in self.phases.items()),
+            "objects": dict(self.objects),
+            "ignored_objects": dict(self.ignored_objects),
+            "updated_objects": dict(self.updated_objects),
+            "deleted_objects": dict(self.deleted_objects),
+            "deferred_relations": self.deferred_relations,
+        }
+
+    def _get_mark(self):
+        return time(), self._counter.count if self._counter is not None else 0
+
+    def _switch_phase(self, name):
+        mark = self._get_mark()
+        if self._current_phase is not None:
+            phase = self.phases[self._current_phase]
+            phase.time += mark[0] - self._mark[0]
+            phase.queries += mark[1] - self._mark[1]
+        if name is not None:
+            self.phases.setdefault(name, PhaseStats())
+        self._current_phase = name
+        self._mark = mark
+
+
+class _QueryCounter(object):
+    """
+    count the queries that are executed on some databases
+    """
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+        self.count = 0
+        self._restore = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        for alias in self.aliases:
+            connection = connections[alias]
+            if hasattr(connection, "execute_wrapper"):
+                wrapper = connection.execute_wrapper(self)
+                wrapper.__enter__()
+                self._restore.append(lambda wrapper=wrapper: wrapper.__exit__(None, None, None))
+            else:
+                # Older versions of Django only report queries to the query log
+                # of the connection, which is used by debug cursors.
+                self._restore.append(self._replace_queries_log(connection))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while self._restore:
+            self._restore.pop()()
+
+    def _replace_queries_log(self, connection):
+        queries_log, force_debug_cursor = connection.queries_log, connection.force_debug_cursor
+        connection.queries_log = _CountingQueriesLog(queries_log, self)
+        connection.force_debug_cursor = True
+
+        def restore():
+            connection.queries_log, connection.force_debug_cursor = queries_log, force_debug_cursor
+        return restore
+
+
+class _CountingQueriesLog(object):
+    """
+    query log of a connection that also counts the logged queries
+    """
+
+    def __init__(self, queries_log, counter):
+        self.queries_log = queries_log
+        self.counter = counter
+
+    def append(self, query):
+        self.counter.count += 1
+        self.queries_log.append(query)
+
+    def __iter__(self):
+        return iter(self.queries_log)
+
+    def __len__(self):
+        return len(self.queries_log)
+
+    def __getattr__(self, name):
+        return getattr(self.queries_log, name)
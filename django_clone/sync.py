@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+from django.apps import apps
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class SyncState(object):
+    """
+    mapping of a synced graph, kept in a JSON file between syncs
+    for every copied row it holds the pk of its copy and the version
+    of the row when it was last copied
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = None
+        # {model: {old pk: (new pk, version)}}
+        self.rows = OrderedDict()
+
+    def load(self):
+        """
+        read the state of the last sync, returns whether there was one
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        self.root = data["root"]
+        self.rows = OrderedDict()
+        for label, rows in data["rows"]:
+            model = apps.get_model(label)
+            to_python = model._meta.pk.to_python
+            self.rows[model] = dict((to_python(old), (to_python(new), version)) for old, new, version in rows)
+        return True
+
+    def save(self):
+        data = {
+            "root": self.root,
+            "rows": [[model._meta.label, [[old, new, version] for old, (new, version) in rows.items()]]
+                     for model, rows in self.rows.items()],
+        }
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(data, f, cls=DjangoJSONEncoder)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary_path, self.path)
+
+    @staticmethod
+    def encode(value):
+        """
+        value as it's read back from the file
+        """
+        return json.loads(json.dumps(value, cls=DjangoJSONEncoder))
+
+
+def get_version(values):
+    """
+    short digest of the field values of a row
+    """
+    return hashlib.sha1(json.dumps(list(values), cls=DjangoJSONEncoder).encode("utf-8")).hexdigest()
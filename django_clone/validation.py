@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+from functools import reduce
+import operator
+
+from django.db import connections
+from django.db.models import Q
+
+from django_clone.utils import chunks, get_in_list_size
+
+
+class Pending(object):
+    """
+    value of a foreign key to an object that hasn't been saved yet
+    it can't match an existing row, but it can match another pending value
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, Pending) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+def find_unique_conflicts(instances, get_value=None, using=None):
+    """
+    check the unique constraints of many unsaved instances at once
+    every constraint of a model is checked with one `__in` (or OR-ed)
+    query per batch, and duplicates among the instances are found in memory
+    get_value(instance, field) returns the value that the instance will be
+    saved with, it defaults to the current attribute value
+    the existing rows are read from the database of using if it's given
+    returns (instance, model class, field names) for every conflict
+    """
+    if get_value is None:
+        get_value = lambda instance, field: getattr(instance, field.attname)
+
+    instances_by_model = OrderedDict()
+    for instance in instances:
+        instances_by_model.setdefault(instance.__class__, []).append(instance)
+
+    conflicts = []
+    for model, model_instances in instances_by_model.items():
+        unique_checks, date_checks = model_instances[0]._get_unique_checks()
+        for model_class, field_names in unique_checks:
+            fields = [model._meta.get_field(name) for name in field_names]
+            if any(field.primary_key for field in fields):
+                # The copies always get new primary keys.
+                continue
+            conflicts.extend(_find_conflicts_of_check(model_class, fields, model_instances, get_value, using))
+
+        if date_checks:
+            for instance in model_instances:
+                if instance._perform_date_checks(date_checks):
+                    conflicts.append((instance, model, tuple(check[2] for check in date_checks)))
+    return conflicts
+
+
+def _find_conflicts_of_check(model_class, fields, instances, get_value, using=None):
+    field_names = tuple(field.name for field in fields)
+    manager = model_class._default_manager.db_manager(using)
+    connection = connections[manager.db]
+
+    instances_by_values = OrderedDict()
+    for instance in instances:
+        values = tuple(get_value(instance, field) for field in fields)
+        if any(value is None or (value == '' and connection.features.interprets_empty_strings_as_nulls)
+               for value in values):
+            # Like validate_unique, don't check incomplete values.
+            continue
+        instances_by_values.setdefault(values, []).append(instance)
+
+    conflicting_values = set(values for values, duplicates in instances_by_values.items() if len(duplicates) > 1)
+
+    # Values that refer to unsaved objects can't exist in the database.
+    candidates = [values for values in instances_by_values
+                  if not any(isinstance(value, Pending) for value in values)]
+    size = get_in_list_size(manager.db)
+    for chunk in chunks(candidates, size // len(fields) if size else None):
+        if len(fields) == 1:
+            queryset = manager.filter(**{field_names[0] + "__in": [values[0] for values in chunk]})
+        else:
+            queryset = manager.filter(reduce(operator.or_, (Q(**dict(zip(field_names, values)))
+                                                             for values in chunk)))
+        attnames = [field.attname for field in fields]
+        for values in queryset.values_list(*attnames):
+            conflicting_values.add(tuple(values))
+
+    return [(instance, model_class, field_names)
+            for values, duplicates in instances_by_values.items() if values in conflicting_values
+            for instance in duplicates]
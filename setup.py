@@ -31,5 +31,5 @@ setup(name='django-clone',
 		author='Mohammad Roghani, Amir Keivan Mohtashami',
 		author_email='mohammad.roghani43@gmail.com, akmohtashami97@gmail.com',
 		license='MIT',
-		packages=['django_clone'],
+		packages=['django_clone', 'django_clone.management', 'django_clone.management.commands'],
 		zip_safe=False)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# Django Clone - https://github.com/mohammadroghani/django-clone
+# Copyright © 2016 Mohammad Roghani <mohammadroghani43@gmail.com>
+# Copyright © 2016 Amir Keivan Mohtashami <akmohtashami97@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+benchmarks of discovery and clone on generated graphs of several shapes
+
+    python -m tests.benchmarks [--shapes fan_out,deep_chain] [--sizes 100,1000] [--output results.json]
+
+every operation is run once for wall time and query count, and once more
+with tracemalloc for peak memory, so the tracing doesn't skew the times
+the results are written as JSON
+
+the default sizes keep a full run short, the 100k-deep chain that checks
+that discovery and clone don't depend on the recursion limit is run with
+
+    python -m tests.benchmarks --shapes deep_chain --sizes 100000
+
+it reads every level of the chain separately, so it takes about twenty
+minutes on SQLite
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import django
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no allocation tracing, so no peak memory is reported.
+    tracemalloc = None
+
+
+def build_fan_out(size):
+    """
+    a question with size choices
+    """
+    from django.utils import timezone
+    from tests.models import Choice, Question
+
+    question = Question.objects.create(question_text='fan out', pub_date=timezone.now())
+    Choice.objects.bulk_create([Choice(question=question, choice_text=str(i)) for i in range(size)])
+    return question
+
+
+def build_deep_chain(size):
+    """
+    a chain of size nodes where every node points to the previous one
+    """
+    from tests.models import Node
+
+    start = (Node.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    Node.objects.bulk_create([Node(id=i, name=str(i), parent_id=i - 1 if i > start else None)
+                              for i in range(start, start + size)])
+    return Node.objects.get(id=start)
+
+
+def build_m2m_cycle(size):
+    """
+    size objects of each of A, B and C, where every object is related
+    to two objects of the next model, so the relations form dense cycles
+    """
+    from tests.models import A, B, C
+
+    a_objects = [A.objects.create() for i in range(size)]
+    b_objects = [B.objects.create() for i in range(size)]
+    c_objects = [C.objects.create() for i in range(size)]
+    for sources, targets, through, source_name, target_name in [
+            (a_objects, b_objects, A.b.through, 'a_id', 'b_id'),
+            (b_objects, c_objects, B.c.through, 'b_id', 'c_id'),
+            (c_objects, a_objects, C.a.through, 'c_id', 'a_id')]:
+        rows = []
+        for i, source in enumerate(sources):
+            for target in set([targets[i], targets[(i + 1) % size]]):
+                rows.append(through(**{source_name: source.pk, target_name: target.pk}))
+        through.objects.bulk_create(rows)
+    return a_objects[0]
+
+
+def build_membership(size):
+    """
+    a group with size students through an explicit membership model
+    """
+    from tests.models import Group, Membership, Student
+
+    group = Group.objects.create(name='group')
+    students = [Student.objects.create(name=str(i)) for i in range(size)]
+    Membership.objects.bulk_create([Membership(group=group, student=student) for student in students])
+    return group
+
+
+def build_inheritance(size):
+    """
+    a question with size choices that are stored in two tables
+    """
+    from django.utils import timezone
+    from tests.models import BigChoice, Question
+
+    question = Question.objects.create(question_text='inheritance', pub_date=timezone.now())
+    for i in range(size):
+        BigChoice.objects.create(question=question, choice_text=str(i))
+    return question
+
+
+SHAPES = [
+    ('fan_out', build_fan_out),
+    ('deep_chain', build_deep_chain),
+    ('m2m_cycle', build_m2m_cycle),
+    ('membership', build_membership),
+    ('inheritance', build_inheritance),
+]
+
+OPERATIONS = [
+    ('discovery', lambda root: len(_cloner().get_all_related_object(root))),
+    ('clone', lambda root: _clone(root)),
+    ('bulk_clone', lambda root: _clone(root, bulk=True)),
+    ('streaming_clone', lambda root: _clone(root, streaming=True)),
+]
+
+
+def _cloner():
+    from django_clone.clone import Cloner
+
+    return Cloner()
+
+
+def _clone(root, **options):
+    cloner = _cloner()
+    cloner.clone(root, **options)
+    return sum(cloner.last_stats.objects.values())
+
+
+def measure(operation, root):
+    """
+    wall time, queries and peak memory of an operation on a graph
+    copies aren't related to the graph, so an operation can run twice
+    """
+    from django.db import DEFAULT_DB_ALIAS
+    from django_clone.stats import _QueryCounter
+
+    # The query log of a connection only keeps the last few thousand queries.
+    with _QueryCounter([DEFAULT_DB_ALIAS]) as counter:
+        start = time.time()
+        objects = operation(root)
+        elapsed = time.time() - start
+
+    peak_memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            operation(root)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "objects": objects,
+        "time": elapsed,
+        "queries": counter.count,
+        "peak_memory": peak_memory,
+    }
+
+
+def run(shapes, sizes):
+    """
+    measure every operation on a new graph of every shape and size
+    """
+    from django.db import connection
+
+    results = []
+    for shape, build in SHAPES:
+        if shape not in shapes:
+            continue
+        for size in sizes:
+            root = build(size)
+            for operation_name, operation in OPERATIONS:
+                result = measure(operation, root)
+                result.update({"shape": shape, "size": size, "operation": operation_name})
+                results.append(result)
+                sys.stderr.write("%s (size=%d) %s: %.2fs, %d queries\n" % (
+                    shape, size, operation_name, result["time"], result["queries"]))
+
+    return {
+        "backend": connection.vendor,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--shapes", default=",".join(shape for shape, build in SHAPES),
+                        help="comma separated graph shapes")
+    parser.add_argument("--sizes", default="100,1000", help="comma separated graph sizes")
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    args = parser.parse_args(argv)
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_settings'
+    django.setup()
+    from django.db import connection
+
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        report = run(args.shapes.split(","), [int(size) for size in args.sizes.split(",")])
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
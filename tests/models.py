@@ -64,3 +64,24 @@ class BigChoice2(Choice):
     unique_value = models.CharField(max_length=100, null=True, unique=True)
     explicit_rel = models.OneToOneField(Choice, parent_link=True)
 
+class Node(models.Model):
+    name = models.CharField(max_length=128)
+    parent = models.ForeignKey('self', null=True, related_name='children')
+
+class Ring(models.Model):
+    next = models.ForeignKey('self', related_name='previous')
+
+class Category(models.Model):
+    code = models.CharField(max_length=32, unique=True)
+
+class Product(models.Model):
+    category = models.ForeignKey(Category, to_field='code', related_name='products')
+
+class Item(models.Model):
+    category = models.ForeignKey(Category, to_field='code', null=True, related_name='items')
+
+class Tag(models.Model):
+    name = models.CharField(max_length=32, primary_key=True)
+
+class Label(models.Model):
+    tag = models.ForeignKey(Tag, related_name='labels')
@@ -22,9 +22,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from django.test import TestCase
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from django_clone.clone import Cloner
+from django.utils.six import StringIO
+import django_clone.clone
+from django_clone.checkpoint import Checkpoint
+from django_clone.clone import BatchEditor, Cloner, CloneCycleError, CloneUniqueError
+from django_clone.signals import clone_phase_finished
 
 from tests.models import *
 
@@ -58,6 +71,16 @@ class VersionControlTests(TestCase):
         test_list.sort()
         self.assertEqual(get_information_list(cloner.get_all_neighbor_objects(question)), test_list)
 
+    def test_get_all_neighbor_objects_after_apply_limits(self):
+        question = Question(question_text='question1', pub_date=timezone.now())
+        question.save()
+        choice = question.choice_set.create(choice_text='a', votes=0)
+        cloner = Cloner()
+        self.assertEqual(get_information_list(cloner.get_all_neighbor_objects(question)),
+                         get_information_list([choice]))
+        cloner.apply_limits(ignored_fields=[("tests.Question", "choice_set")])
+        self.assertEqual(cloner.get_all_neighbor_objects(question), [])
+
     def test_get_all_related_objects(self):
         question = Question(question_text='question1', pub_date=timezone.now())
         q1 = Question(question_text='q1', pub_date=timezone.now())
@@ -104,6 +127,43 @@ class VersionControlTests(TestCase):
         self.assertEqual(get_information_list(cloner.get_all_related_object(b_object)), test_list)
         self.assertEqual(get_information_list(cloner.get_all_related_object(c_object)), test_list)
 
+    def test_get_all_related_objects_query_count(self):
+        def count_queries(number_of_persons):
+            question = Question(question_text='question', pub_date=timezone.now())
+            question.save()
+            for i in range(number_of_persons):
+                person = Person()
+                person.save()
+                person.questions.add(question)
+            with CaptureQueriesContext(connection) as context:
+                related_objects = Cloner().get_all_related_object(question)
+            self.assertEqual(len(related_objects), number_of_persons + 1)
+            return len(context.captured_queries)
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_get_all_related_objects_with_subclasses_query_count(self):
+        def count_queries(number_of_choices):
+            question = Question.objects.create(question_text='question', pub_date=timezone.now())
+            for i in range(number_of_choices):
+                Choice.objects.create(question=question, choice_text='choice', votes=0)
+                BigChoice.objects.create(question=question, choice_text='big', votes=0)
+                BigChoice2.objects.create(question=question, choice_text='big2', votes=0)
+            with CaptureQueriesContext(connection) as context:
+                related_objects = Cloner().get_all_related_object(question)
+            classes = [obj.__class__ for obj in related_objects]
+            self.assertEqual([classes.count(model) for model in [Question, Choice, BigChoice, BigChoice2]],
+                             [1, number_of_choices, number_of_choices, number_of_choices])
+            return len(context.captured_queries)
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_get_all_related_objects_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        Node.objects.bulk_create([Node(id=i, name=str(i), parent_id=i - 1 if i > 1 else None)
+                                  for i in range(1, depth + 1)])
+        self.assertEqual(len(Cloner().get_all_related_object(Node.objects.get(id=depth // 2))), depth)
+        Cloner().clone(Node.objects.get(id=1))
+        self.assertEqual(Node.objects.count(), 2 * depth)
+
     def test_clone_with_one_object(self):
         question = Question(question_text='a', pub_date=timezone.now())
         question.save()
@@ -112,6 +172,30 @@ class VersionControlTests(TestCase):
         self.assertEqual(q.question_text, question.question_text)
         self.assertEqual(q.pub_date, question.pub_date)
 
+    def test_clone_many_with_shared_object(self):
+        q1 = Question.objects.create(question_text='q1', pub_date=timezone.now())
+        q2 = Question.objects.create(question_text='q2', pub_date=timezone.now())
+        person = Person.objects.create()
+        person.questions.add(q1, q2)
+        mapping = Cloner().clone_many([q1, q2])
+        self.assertEqual(list(mapping), [q1, q2])
+        self.assertEqual(mapping[q1].question_text, 'q1')
+        self.assertEqual(mapping[q2].question_text, 'q2')
+        self.assertEqual(Person.objects.count(), 2)
+        new_person = Person.objects.exclude(pk=person.pk).get()
+        self.assertEqual(set(new_person.questions.all()), {mapping[q1], mapping[q2]})
+
+    def test_clone_many_with_ignored_instance(self):
+        q1 = Question.objects.create(question_text='q1', pub_date=timezone.now())
+        q2 = Question.objects.create(question_text='q2', pub_date=timezone.now())
+        person = Person.objects.create()
+        person.questions.add(q1, q2)
+        mapping = Cloner(ignored_instances={person: person}).clone_many([q1, q2])
+        self.assertEqual(Person.objects.count(), 1)
+        self.assertEqual(Question.objects.count(), 4)
+        self.assertEqual(set(person.questions.all()), {q1, q2})
+        self.assertNotIn(mapping[q1].pk, (q1.pk, q2.pk))
+
     def test_clone_with_foreign_key(self):
         question = Question(question_text='a', pub_date=timezone.now())
         question.save()
@@ -135,6 +219,22 @@ class VersionControlTests(TestCase):
         self.assertNotEqual(choice.id, c.id)
         self.assertEqual(choice.question.id, c.question.id)
 
+    def test_get_all_related_objects_with_blocking_rules(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        choice = Choice(question=question, choice_text='c', votes=0)
+        choice.save()
+        big_choice = BigChoice(question=question, choice_text='d', votes=0)
+        big_choice.save()
+        all_objects = get_information_list([question, choice, big_choice])
+        self.assertEqual(get_information_list(Cloner(blocking_models=["tests.Question"]).get_all_related_object(choice)),
+                         get_information_list([question, choice]))
+        self.assertEqual(get_information_list(Cloner(blocking_instances=[question]).get_all_related_object(choice)),
+                         get_information_list([question, choice]))
+        # Blocking rules check the exact type of the objects.
+        self.assertEqual(get_information_list(Cloner(blocking_models=["tests.BigChoice"]).get_all_related_object(choice)),
+                         all_objects)
+
     def test_clone_with_many_to_many_field(self):
         question = Question(question_text='question1', pub_date=timezone.now())
         question.save()
@@ -184,6 +284,32 @@ class VersionControlTests(TestCase):
         s = Cloner().clone(student)
         self.assertEqual(s.group_set.all().count(),  student.group_set.all().count())
 
+    def test_clone_with_through_field_not_followed(self):
+        student = Student(name='Ali')
+        group = Group(name='ACM')
+        student.save()
+        group.save()
+        Membership(student=student, group=group).save()
+        Membership(student=student, group=group).save()
+        cloner = Cloner(ignored_fields=[("tests.Group", "membership_set"), ("tests.Student", "membership_set")])
+        g = cloner.clone(group)
+        self.assertEqual(Membership.objects.count(), 4)
+        self.assertEqual(g.members.count(), 2)
+        self.assertNotEqual(g.members.all()[0].pk, student.pk)
+
+    def test_clone_many_to_many_query_count(self):
+        def count_queries(number_of_questions):
+            person = Person()
+            person.save()
+            for i in range(number_of_questions):
+                person.questions.add(Question.objects.create(question_text='q', pub_date=timezone.now()))
+            cloner = Cloner(ignored_models=["tests.Question"])
+            with CaptureQueriesContext(connection) as context:
+                p = cloner.clone(person)
+            self.assertEqual(p.questions.count(), number_of_questions)
+            return len(context.captured_queries)
+        self.assertEqual(count_queries(2), count_queries(10))
+
     def test_clone_subclass(self):
         question = Question(question_text='a', pub_date=timezone.now())
         question.save()
@@ -219,3 +345,695 @@ class VersionControlTests(TestCase):
         choice.save()
         new_choice = Cloner().clone(choice, unique_editor)
         self.assertNotEqual(new_choice.pk, choice.pk)
+
+    def test_clone_with_batch_editor(self):
+        class UniqueEditor(BatchEditor):
+            def __init__(self, prefix):
+                self.prefix = prefix
+                self.count = 0
+                self.calls = []
+
+            def edit(self, model, objs):
+                self.calls.append((model, len(objs)))
+                if model is BigChoice:
+                    for obj in objs:
+                        obj.unique_value = "%s %d" % (self.prefix, self.count)
+                        self.count += 1
+                return objs
+
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(3):
+            BigChoice.objects.create(question=question, choice_text='c', votes=0, unique_value=str(i))
+        editor = UniqueEditor('copy')
+        q = Cloner().clone(question, editor, bulk=True)
+        self.assertEqual(sorted(BigChoice.objects.filter(question=q).values_list('unique_value', flat=True)),
+                         ['copy 0', 'copy 1', 'copy 2'])
+        self.assertEqual(sorted(editor.calls, key=lambda call: call[0].__name__), [(BigChoice, 3), (Question, 1)])
+
+        # Streaming clones edit the copies of every chunk together.
+        editor = UniqueEditor('stream')
+        Cloner().clone(Question.objects.get(pk=question.pk), editor, streaming=True, chunk_size=2)
+        self.assertEqual(editor.calls, [(Question, 1), (BigChoice, 2), (BigChoice, 1)])
+
+    def test_clone_with_not_null_cycle(self):
+        first = Ring(id=1, next_id=2)
+        second = Ring(id=2, next_id=1)
+        first.save()
+        second.save()
+        with self.assertRaises(CloneCycleError) as context:
+            Cloner().clone(first)
+        self.assertEqual(set(context.exception.cycle), {first, second})
+        self.assertEqual(Ring.objects.count(), 2)
+
+    def test_clone_with_not_null_cycle_and_deferred_constraints(self):
+        first = Ring(id=1, next_id=2)
+        second = Ring(id=2, next_id=1)
+        first.save()
+        second.save()
+        for bulk in (False, True):
+            new_first = Cloner().clone(first, bulk=bulk, defer_constraints=True)
+            self.assertNotIn(new_first.pk, (first.pk, second.pk))
+            self.assertNotIn(new_first.next_id, (first.pk, second.pk))
+            self.assertEqual(Ring.objects.get(pk=new_first.next_id).next_id, new_first.pk)
+        self.assertEqual(Ring.objects.count(), 6)
+
+    def test_clone_with_not_null_self_reference(self):
+        Ring.objects.bulk_create([Ring(id=1, next_id=1), Ring(id=2, next_id=1), Ring(id=3, next_id=2)])
+        first = Ring.objects.get(id=1)
+        cloner = Cloner(ignored_instances={first: first}, blocking_instances=[first])
+        self.assertIsNone(cloner.plan(Ring.objects.get(id=3)).cycle)
+        for options in [{}, {'bulk': True}, {'streaming': True, 'chunk_size': 1}]:
+            new_last = cloner.clone(Ring.objects.get(id=3), **options)
+            self.assertNotIn(new_last.next_id, (1, 2, 3))
+            self.assertEqual(new_last.next.next_id, 1)
+        self.assertEqual(Ring.objects.count(), 9)
+
+        # Rows that refer to each other are still reported.
+        Ring.objects.filter(id=1).update(next_id=2)
+        for options in [{'bulk': True}, {'streaming': True}]:
+            with self.assertRaises(CloneCycleError) as context:
+                Cloner().clone(Ring.objects.get(id=1), **options)
+            self.assertEqual(set(context.exception.cycle), {Ring(id=1), Ring(id=2)})
+        self.assertEqual(set(Cloner().plan(Ring.objects.get(id=1)).cycle), {('tests.Ring', 1), ('tests.Ring', 2)})
+
+    def test_clone_is_rolled_back_on_failure(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        BigChoice(question=question, choice_text='c', votes=0, unique_value="S").save()
+        with self.assertRaises(ValueError):
+            Cloner().clone(question)
+        self.assertEqual(Question.objects.count(), 1)
+        self.assertEqual(Choice.objects.count(), 1)
+
+    def test_clone_unique_conflicts_are_reported_together(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        first = BigChoice(question=question, choice_text='c', votes=0, unique_value="S")
+        first.save()
+        second = BigChoice(question=question, choice_text='d', votes=0, unique_value="T")
+        second.save()
+        BigChoice(question=question, choice_text='e', votes=0).save()
+        cloner = Cloner()
+        with self.assertRaises(CloneUniqueError) as context:
+            cloner.clone(question, count_queries=True)
+        self.assertEqual(set(obj for obj, field_names in context.exception.conflicts), {first, second})
+        self.assertEqual(cloner.last_stats.phases['validation'].queries, 1)
+
+        def same_value_editor(obj):
+            if isinstance(obj, BigChoice) and obj.unique_value is not None:
+                obj.unique_value = "U"
+            return obj
+        with self.assertRaises(CloneUniqueError) as context:
+            Cloner().clone(question, same_value_editor)
+        self.assertEqual(set(obj for obj, field_names in context.exception.conflicts), {first, second})
+        self.assertEqual(Choice.objects.count(), 3)
+
+    def test_clone_stats(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        Choice(question=question, choice_text='c', votes=0).save()
+        Choice(question=question, choice_text='d', votes=0).save()
+        person = Person()
+        person.save()
+        person.questions.add(question)
+        phases = []
+
+        def on_phase_finished(sender, cloner, phase, stats, **kwargs):
+            phases.append(phase)
+
+        clone_phase_finished.connect(on_phase_finished)
+        try:
+            cloner = Cloner()
+            with CaptureQueriesContext(connection) as context:
+                cloner.clone(question, count_queries=True)
+        finally:
+            clone_phase_finished.disconnect(on_phase_finished)
+        stats = cloner.last_stats
+        self.assertEqual(phases, ['discovery', 'copy', 'validation', 'insert', 'many_to_many'])
+        self.assertEqual(stats.queries, len(context.captured_queries))
+        self.assertLessEqual(sum(phase.queries for phase in stats.phases.values()), stats.queries)
+        self.assertEqual(stats.phases['insert'].queries, 4)
+        self.assertEqual(stats.dominant_models(1), [('tests.Choice', 2)])
+        self.assertEqual(stats.as_dict()['objects']['tests.Question'], 1)
+
+    def test_bulk_clone_with_foreign_key(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        Choice(question=question, choice_text='c', votes=0).save()
+        Choice(question=question, choice_text='d', votes=1).save()
+        q = Cloner().clone(question, bulk=True, batch_size=1)
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(sorted(q.choice_set.values_list('choice_text', 'votes')),
+                         sorted(question.choice_set.values_list('choice_text', 'votes')))
+
+    def test_bulk_clone_with_many_to_many_and_subclass(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        BigChoice(question=question, choice_text='c', votes=0).save()
+        person = Person()
+        person.save()
+        person.questions.add(question)
+        p = Cloner().clone(person, bulk=True)
+        self.assertNotEqual(p.pk, person.pk)
+        q = p.questions.get()
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(BigChoice.objects.filter(question=q).count(), 1)
+        self.assertEqual(Choice.objects.count(), 2)
+
+    def test_bulk_clone_with_nullable_back_reference(self):
+        root = Node.objects.create(name='root')
+        child = Node.objects.create(name='child', parent=root)
+        Node.objects.create(name='grandchild', parent=child)
+        new_child = Cloner().clone(child, bulk=True)
+        self.assertEqual(Node.objects.count(), 6)
+        self.assertNotEqual(new_child.pk, child.pk)
+        self.assertNotEqual(new_child.parent.pk, root.pk)
+        self.assertEqual(new_child.parent.name, 'root')
+        self.assertEqual(new_child.children.get().name, 'grandchild')
+
+    def test_streaming_clone(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        Choice(question=question, choice_text='c', votes=0).save()
+        BigChoice(question=question, choice_text='d', votes=1).save()
+        person = Person()
+        person.save()
+        person.questions.add(question)
+        p = Cloner().clone(person, streaming=True, chunk_size=1)
+        self.assertNotEqual(p.pk, person.pk)
+        q = p.questions.get()
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(sorted(q.choice_set.values_list('choice_text', 'votes')), [('c', 0), ('d', 1)])
+        self.assertEqual(BigChoice.objects.filter(question=q).count(), 1)
+        self.assertEqual(Choice.objects.count(), 4)
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_streaming_clone_with_nullable_back_reference(self):
+        root = Node.objects.create(name='root')
+        child = Node.objects.create(name='child', parent=root)
+        Node.objects.create(name='grandchild', parent=child)
+        cloner = Cloner()
+        new_child = cloner.clone(child, streaming=True, chunk_size=2)
+        self.assertEqual(Node.objects.count(), 6)
+        self.assertNotEqual(new_child.pk, child.pk)
+        self.assertNotEqual(new_child.parent.pk, root.pk)
+        self.assertEqual(new_child.parent.name, 'root')
+        self.assertEqual(new_child.children.get().name, 'grandchild')
+        self.assertEqual(cloner.last_stats.objects['tests.Node'], 3)
+
+    def test_streaming_clone_matches_related_objects(self):
+        question = Question(question_text='a', pub_date=timezone.now())
+        question.save()
+        BigChoice2(question=question, choice_text='c', votes=0).save()
+        group = Group.objects.create(name='g')
+        student = Student.objects.create(name='s')
+        Membership.objects.create(student=student, group=group)
+        cloner = Cloner()
+        pks_by_model = cloner._get_all_related_pks([question], 1)
+        self.assertEqual(sorted((pk, model.__name__) for model, pks in pks_by_model.items() for pk in pks),
+                         sorted((obj.pk, obj.__class__.__name__) for obj in cloner.get_all_related_object(question)))
+        g = cloner.clone(group, streaming=True)
+        self.assertEqual(g.members.get().name, 's')
+        self.assertEqual(Membership.objects.count(), 2)
+
+    def test_clone_with_foreign_key_to_non_primary_key(self):
+        def code_editor(obj):
+            if isinstance(obj, Category):
+                obj.code += '-copy'
+            return obj
+        category = Category.objects.create(code='c')
+        Product.objects.create(category=category)
+        Product.objects.create(category=category)
+        with CaptureQueriesContext(connection) as context:
+            c = Cloner().clone(category, code_editor, bulk=True)
+        self.assertEqual(c.code, 'c-copy')
+        self.assertEqual(c.products.count(), 2)
+        self.assertEqual(Product.objects.filter(category=category).count(), 2)
+        # The foreign keys are mapped without loading their targets one by one.
+        self.assertFalse([query for query in context.captured_queries
+                          if 'WHERE "tests_category"."code" = ' in query['sql']])
+
+    def test_streaming_clone_with_foreign_key_to_non_primary_key(self):
+        def code_editor(obj):
+            if isinstance(obj, Category):
+                obj.code += '-copy'
+            return obj
+        category = Category.objects.create(code='c')
+        Product.objects.create(category=category)
+        item = Item.objects.create(category=category)
+        # The item is inserted before the category it refers to.
+        new_item = Cloner().clone(item, code_editor, streaming=True)
+        self.assertEqual(new_item.category_id, 'c-copy')
+        self.assertEqual(new_item.category.products.count(), 1)
+        self.assertEqual(Item.objects.filter(category=category).count(), 1)
+
+    def test_clone_loads_only_copied_rows(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(3):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        with CaptureQueriesContext(connection) as context:
+            q = Cloner(ignored_models=['tests.Choice']).clone(question)
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(Choice.objects.count(), 3)
+        # Discovery reads keys, and the full rows are only loaded for the copies.
+        # The root is copied as it was passed.
+        for column in ['"tests_choice"."choice_text"', '"tests_question"."question_text"']:
+            self.assertFalse([query for query in context.captured_queries
+                              if query['sql'].startswith('SELECT') and column in query['sql']])
+
+    def test_clone_copies_unsaved_changes_of_roots(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        Choice.objects.create(question=question, choice_text='c', votes=0)
+        question.question_text = 'edited in memory'
+        cloner = Cloner().use_discovery_cache()
+        for i in range(2):
+            q = cloner.clone(question)
+            self.assertEqual(q.question_text, 'edited in memory')
+            self.assertEqual(q.choice_set.get().choice_text, 'c')
+        self.assertEqual(cloner.clone(Question.objects.get(pk=question.pk)).question_text, 'a')
+
+    def test_clone_foreign_key_query_count(self):
+        def count_queries(number_of_questions):
+            Choice.objects.all().delete()
+            for i in range(number_of_questions):
+                question = Question.objects.create(question_text='q%d' % i, pub_date=timezone.now())
+                Choice.objects.create(question=question, choice_text='c', votes=0)
+            cloner = Cloner()
+            with CaptureQueriesContext(connection) as context:
+                cloner.clone_many(Choice.objects.all())
+            for choice in Choice.objects.all():
+                self.assertEqual(cloner.get_all_neighbor_objects(choice), [choice.question])
+            # The questions are loaded once per level, not once per choice.
+            return len([query for query in context.captured_queries
+                        if 'FROM "tests_question"' in query['sql'] and 'INSERT' not in query['sql']])
+        self.assertEqual(count_queries(2), count_queries(10))
+
+    def test_get_all_neighbor_objects_reads_foreign_keys_of_the_object(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        choice = Choice.objects.create(question=question, choice_text='c', votes=0)
+        other = Question.objects.create(question_text='b', pub_date=timezone.now())
+        choice.question = other
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(Cloner().get_all_neighbor_objects(choice), [other])
+        self.assertFalse([query for query in context.captured_queries
+                          if '"tests_choice"."question_id"' in query['sql']])
+
+    def test_plan(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        choice = Choice.objects.create(question=question, choice_text='c', votes=0)
+        BigChoice.objects.create(question=question, choice_text='d', votes=0, unique_value='u')
+        person = Person.objects.create()
+        person.questions.add(question)
+        cloner = Cloner(blocking_models=['tests.Person'], ignored_fields=[('tests.Choice', 'bigchoice2')],
+                        ignored_instances={choice: choice})
+        with CaptureQueriesContext(connection) as context:
+            plan = cloner.plan(question)
+        self.assertFalse([query for query in context.captured_queries if not query['sql'].startswith('SELECT')])
+        self.assertEqual(plan.queries, len(context.captured_queries))
+        self.assertEqual(plan.objects, {'tests.Question': 1, 'tests.Person': 1, 'tests.BigChoice': 1})
+        self.assertEqual(plan.ignored_objects, {'tests.Choice': 1})
+        self.assertEqual(plan.order.index('tests.Question'), 0)
+        self.assertEqual(plan.pruned_edges, {('tests.Question', 'person_set', 'blocking_models'): 1,
+                                             ('tests.Choice', 'bigchoice2', 'ignored_fields'): 1})
+        self.assertEqual(plan.unique_conflicts, {('tests.BigChoice', ('unique_value',)): 1})
+        self.assertTrue(plan.conflicts_likely)
+        self.assertEqual(Question.objects.count(), 1)
+
+    def test_plan_estimated_queries(self):
+        group = Group.objects.create(name='g')
+        for name in ['a', 'b']:
+            Membership.objects.create(student=Student.objects.create(name=name), group=group)
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        Person.objects.create().questions.add(question)
+        for obj in [group, question]:
+            cloner = Cloner()
+            plan = cloner.plan(obj)
+            cloner.clone(obj, count_queries=True)
+            self.assertEqual(plan.estimated_queries, cloner.last_stats.queries)
+
+    def test_streaming_clone_in_sql(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(5):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        BigChoice.objects.create(question=question, choice_text='big', votes=0)
+        Choice.objects.create(question=Question.objects.create(question_text='b', pub_date=timezone.now()),
+                              choice_text='other', votes=0)
+        person = Person.objects.create()
+        person.questions.add(question)
+        cloner = Cloner(blocking_models=['tests.Person'])
+        for editor in [None, lambda obj: obj]:
+            with CaptureQueriesContext(connection) as context:
+                q = cloner.clone(question, editor, streaming=True, sql=True, chunk_size=2)
+            self.assertNotEqual(q.pk, question.pk)
+            self.assertEqual(sorted(q.choice_set.values_list('choice_text', 'votes')),
+                             sorted(question.choice_set.values_list('choice_text', 'votes')))
+            self.assertEqual(BigChoice.objects.filter(question=q).count(), 1)
+            self.assertEqual(q.person_set.count(), 1)
+            self.assertEqual(cloner.last_stats.objects['tests.Choice'], 5)
+            copied_in_sql = [query for query in context.captured_queries
+                             if query['sql'].startswith('INSERT INTO "tests_choice"') and 'SELECT' in query['sql']]
+            # Copies that go through an editor are made in Python.
+            self.assertEqual(len(copied_in_sql), 3 if editor is None else 0)
+        self.assertEqual(Choice.objects.count(), 19)
+
+    def test_failed_streaming_clone_in_sql(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        Choice.objects.create(question=question, choice_text='c', votes=0)
+        BigChoice.objects.create(question=question, choice_text='big', votes=0, unique_value='u')
+        self.assertRaises(ValueError, Cloner().clone, question, streaming=True, sql=True, atomic=False)
+        # The big choice fails after the choice was copied in the database.
+        with CaptureQueriesContext(connection) as context, self.assertRaises(CloneUniqueError):
+            Cloner().clone(question, streaming=True, sql=True)
+        self.assertTrue([query for query in context.captured_queries
+                         if query['sql'].startswith('INSERT INTO "tests_choice"') and 'SELECT' in query['sql']])
+        self.assertEqual(Choice.objects.count(), 2)
+        BigChoice.objects.update(unique_value=None)
+        q = Cloner().clone(question, streaming=True, sql=True)
+        self.assertEqual(q.choice_set.count(), 2)
+
+    def test_streaming_clone_in_sql_with_foreign_key_to_non_integer_key(self):
+        label = Label.objects.create(tag=Tag.objects.create(name='t'))
+        with CaptureQueriesContext(connection) as context:
+            new_label = Cloner(ignored_models=['tests.Tag']).clone(label, streaming=True, sql=True)
+        self.assertNotEqual(new_label.pk, label.pk)
+        self.assertEqual(new_label.tag_id, 't')
+        # The keys of tags can't be mapped in the table of the database.
+        self.assertFalse([query for query in context.captured_queries
+                          if query['sql'].startswith('INSERT INTO "tests_label"') and 'SELECT' in query['sql']])
+
+    def test_discovery_cache(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(3):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        person = Person.objects.create()
+        person.questions.add(question)
+        cloner = Cloner(blocking_models=['tests.Person']).use_discovery_cache(max_size=1)
+        cloner.clone(question, count_queries=True)
+        self.assertGreater(cloner.last_stats.phases['discovery'].queries, 0)
+        q = cloner.clone(question, count_queries=True)
+        self.assertEqual(cloner.last_stats.phases['discovery'].queries, 0)
+        self.assertEqual(q.choice_set.count(), 3)
+        self.assertEqual(q.person_set.count(), 1)
+
+        # New references to the graph make it stale.
+        Choice.objects.create(question=question, choice_text='new', votes=0)
+        self.assertEqual(cloner.clone(question).choice_set.count(), 4)
+        question.question_text = 'b'
+        question.save()
+        self.assertEqual(cloner.clone(question).question_text, 'b')
+        Person.objects.create().questions.add(question)
+        self.assertEqual(cloner.clone(question).person_set.count(), 2)
+        self.assertEqual(len(cloner.discovery_cache), 1)
+
+        # Only the most recently used graph is kept.
+        other = Question.objects.create(question_text='c', pub_date=timezone.now())
+        cloner.clone(other)
+        self.assertNotIn(((Question, question.pk),), cloner.discovery_cache)
+
+    def test_discovery_cache_after_copies_refer_to_the_graph(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        person = Person.objects.create()
+        person.questions.add(question)
+        cloner = Cloner(ignored_models=['tests.Question']).use_discovery_cache()
+        for options in [{}, {'streaming': True}, {}, {'bulk': True}]:
+            # The copies of the earlier clones refer to the question, so they join the graph.
+            expected = Cloner(ignored_models=['tests.Question']).plan(person).objects
+            cloner.clone(person, **options)
+            self.assertEqual(cloner.last_stats.objects['tests.Person'], expected['tests.Person'])
+        self.assertEqual(Person.objects.count(), 16)
+
+
+class ParallelCloneTests(TransactionTestCase):
+
+    def test_parallel_clone(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(5):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        BigChoice.objects.create(question=question, choice_text='big', votes=0)
+        person = Person.objects.create()
+        person.questions.add(question)
+        root = Node.objects.create(name='root')
+        for i in range(3):
+            Node.objects.create(name=str(i), parent=root)
+        cloner = Cloner()
+        new_objects = cloner.clone_many([person, root], streaming=True, atomic=False, chunk_size=2, workers=3)
+        q = new_objects[person].questions.get()
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(sorted(q.choice_set.values_list('choice_text', 'votes')),
+                         sorted(question.choice_set.values_list('choice_text', 'votes')))
+        self.assertEqual(BigChoice.objects.filter(question=q).count(), 1)
+        self.assertEqual(sorted(new_objects[root].children.values_list('name', flat=True)), ['0', '1', '2'])
+        self.assertEqual(Node.objects.count(), 8)
+        self.assertEqual(cloner.last_stats.objects['tests.Choice'], 5)
+
+    def test_parallel_clone_splits_levels_into_shards(self):
+        levels = []
+
+        class RecordingPool(ThreadPool):
+            def map(self, func, tasks):
+                levels.append(sorted((model.__name__, len(pks)) for model, pks in tasks))
+                return super(RecordingPool, self).map(func, tasks)
+
+        # SQLite copies the shards one after the other, so the tasks of every level are checked instead.
+        self.addCleanup(setattr, django_clone.clone, 'ThreadPool', ThreadPool)
+        django_clone.clone.ThreadPool = RecordingPool
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(5):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        BigChoice.objects.create(question=question, choice_text='big', votes=0)
+        person = Person.objects.create()
+        person.questions.add(question)
+        root = Node.objects.create(name='root')
+        for i in range(3):
+            Node.objects.create(name=str(i), parent=root)
+        Cloner().clone_many([person, root], streaming=True, atomic=False, chunk_size=2, workers=3)
+        self.assertEqual(levels, [[('Node', 2), ('Node', 2), ('Person', 1), ('Question', 1)],
+                                  [('BigChoice', 1), ('Choice', 1), ('Choice', 2), ('Choice', 2)]])
+
+    def test_parallel_clone_needs_streaming_without_transaction(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        self.assertRaises(ValueError, Cloner().clone, question, streaming=True, workers=2)
+        self.assertRaises(ValueError, Cloner().clone, question, atomic=False, workers=2)
+
+
+class ResumableCloneTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.checkpoint = os.path.join(directory, 'clone.log')
+        self.question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(5):
+            Choice.objects.create(question=self.question, choice_text=str(i), votes=i)
+        BigChoice.objects.create(question=self.question, choice_text='big', votes=0)
+        for i in range(3):
+            Person.objects.create().questions.add(self.question)
+
+    def assertCloned(self, new_question):
+        self.assertNotEqual(new_question.pk, self.question.pk)
+        self.assertEqual(sorted(new_question.choice_set.values_list('choice_text', flat=True)),
+                         ['0', '1', '2', '3', '4', 'big'])
+        self.assertEqual(new_question.person_set.count(), 3)
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(Choice.objects.count(), 12)
+        self.assertEqual(BigChoice.objects.count(), 2)
+        self.assertEqual(Person.objects.count(), 6)
+        self.assertEqual(Person.questions.through.objects.count(), 6)
+
+    def test_resume_after_failed_chunk(self):
+        calls = []
+
+        def failing_editor(obj):
+            calls.append(obj)
+            if len(calls) == 6:
+                raise RuntimeError("worker died")
+            return obj
+
+        with self.assertRaises(RuntimeError):
+            Cloner().clone_resumable(self.question, self.checkpoint, failing_editor, chunk_size=2)
+        # Some chunks were committed before it failed.
+        self.assertGreater(Question.objects.count() + Choice.objects.count() + Person.objects.count(), 10)
+        progress = []
+        new_question = Cloner().clone_resumable(self.question, self.checkpoint, chunk_size=2,
+                                                progress=lambda *args: progress.append(args))
+        self.assertCloned(new_question)
+        self.assertTrue(progress)
+        self.assertTrue(all(done <= total for label, done, total, rate in progress))
+
+        # A finished clone only returns the copy.
+        self.assertEqual(Cloner().clone_resumable(self.question, self.checkpoint), new_question)
+        self.assertCloned(new_question)
+
+    def test_resume_after_uncommitted_step(self):
+        class FailingCheckpoint(Checkpoint):
+            def __init__(self, path, failing_step):
+                super(FailingCheckpoint, self).__init__(path)
+                self.failing_step = failing_step
+
+            def add(self, step):
+                # The step is logged, but its transaction is rolled back.
+                super(FailingCheckpoint, self).add(step)
+                if len(self.steps) == self.failing_step:
+                    raise RuntimeError("worker died")
+
+        # Once while inserting rows and once while copying many-to-many relations.
+        for failing_step, phase in [(3, 'insert'), (12, 'many_to_many')]:
+            checkpoint = FailingCheckpoint(self.checkpoint, failing_step)
+            with self.assertRaises(RuntimeError):
+                Cloner().clone_resumable(self.question, checkpoint, chunk_size=2)
+            self.assertEqual(checkpoint.steps[-1]['phase'], phase)
+        self.assertCloned(Cloner().clone_resumable(self.question, self.checkpoint))
+
+        # And once while patching a reference to a row that was inserted later.
+        Node.objects.bulk_create([Node(id=2, name='root'), Node(id=1, name='child', parent_id=2)])
+        path = self.checkpoint + '.nodes'
+        checkpoint = FailingCheckpoint(path, 3)
+        with self.assertRaises(RuntimeError):
+            Cloner().clone_resumable(Node.objects.get(id=2), checkpoint, chunk_size=1)
+        self.assertEqual(checkpoint.steps[-1]['phase'], 'relations')
+        new_root = Cloner().clone_resumable(Node.objects.get(id=2), path)
+        self.assertNotEqual(new_root.pk, 2)
+        self.assertEqual(new_root.children.get().name, 'child')
+
+    def test_resume_other_object(self):
+        Cloner().clone_resumable(self.question, self.checkpoint)
+        with self.assertRaises(ValueError):
+            Cloner().clone_resumable(Choice.objects.first(), self.checkpoint)
+
+    def test_clone_graph_command(self):
+        out = StringIO()
+        call_command('clone_graph', 'tests.Question', str(self.question.pk), '--checkpoint', self.checkpoint,
+                     '--chunk-size', '2', '--block-model', 'tests.Person', stdout=out)
+        self.assertIn('tests.Choice: 2/5 rows', out.getvalue())
+        self.assertIn('Cloned tests.Question %d' % self.question.pk, out.getvalue())
+        self.assertEqual(Question.objects.count(), 2)
+
+
+class SyncTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state = os.path.join(directory, 'state.json')
+
+    def test_sync(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        choices = [Choice.objects.create(question=question, choice_text=str(i), votes=i) for i in range(3)]
+        big_choice = BigChoice.objects.create(question=question, choice_text='big', votes=0, unique_value='u')
+        persons = [Person.objects.create() for i in range(2)]
+        for person in persons:
+            person.questions.add(question)
+
+        def unique_editor(obj):
+            if isinstance(obj, BigChoice):
+                obj.unique_value += ' copy'
+            return obj
+
+        cloner = Cloner()
+        q = cloner.sync(question, self.state, unique_editor)
+        self.assertNotEqual(q.pk, question.pk)
+        self.assertEqual(Choice.objects.filter(question=q).count(), 4)
+        self.assertEqual(q.person_set.count(), 2)
+
+        # Nothing changed.
+        self.assertEqual(cloner.sync(question, self.state, unique_editor), q)
+        self.assertEqual(sum(cloner.last_stats.objects.values()), 0)
+        self.assertEqual(cloner.last_stats.updated_objects, {})
+        self.assertEqual(cloner.last_stats.deleted_objects, {})
+        self.assertEqual(Choice.objects.count(), 8)
+
+        choices[0].choice_text = 'changed'
+        choices[0].save()
+        choices[1].delete()
+        big_choice.votes = 10
+        big_choice.unique_value = 'v'
+        big_choice.save()
+        Choice.objects.create(question=question, choice_text='new', votes=0)
+        persons[0].questions.remove(question)
+        Person.objects.create().questions.add(question)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(cloner.sync(question, self.state, unique_editor), q)
+        self.assertEqual(sorted(Choice.objects.filter(question=q).values_list('choice_text', 'votes')),
+                         sorted(Choice.objects.filter(question=question).values_list('choice_text', 'votes')))
+        self.assertEqual(BigChoice.objects.get(question=q).unique_value, 'v copy')
+        self.assertEqual(q.person_set.count(), 2)
+        self.assertEqual(cloner.last_stats.objects['tests.Choice'], 1)
+        self.assertEqual(cloner.last_stats.updated_objects, {'tests.Choice': 1, 'tests.BigChoice': 1})
+        self.assertEqual(cloner.last_stats.deleted_objects['tests.Choice'], 1)
+        # The copies of unchanged rows aren't written.
+        self.assertFalse([query for query in context.captured_queries
+                          if query['sql'].startswith('UPDATE "tests_question"')])
+
+        with self.assertRaises(ValueError):
+            cloner.sync(choices[0], self.state)
+
+
+class CrossDatabaseCloneTests(TestCase):
+    multi_db = True
+
+    def test_clone_to_other_database(self):
+        question = Question.objects.create(question_text='a', pub_date=timezone.now())
+        for i in range(5):
+            Choice.objects.create(question=question, choice_text=str(i), votes=i)
+        BigChoice.objects.create(question=question, choice_text='big', votes=0)
+        person = Person.objects.create()
+        person.questions.add(question)
+        category = Category.objects.create(code='c')
+        Product.objects.create(category=category)
+
+        cloner = Cloner()
+        q = cloner.clone(question, source='default', target='other', batch_size=2)
+        c = cloner.clone(category, source='default', target='other')
+        self.assertEqual(q._state.db, 'other')
+        self.assertEqual(Question.objects.using('other').count(), 1)
+        self.assertEqual(sorted(Choice.objects.using('other').filter(question=q).values_list('choice_text', 'votes')),
+                         sorted(question.choice_set.values_list('choice_text', 'votes')))
+        self.assertEqual(BigChoice.objects.using('other').filter(question=q).count(), 1)
+        self.assertEqual(Person.objects.using('other').get().questions.get(), q)
+        self.assertEqual(Product.objects.using('other').get().category_id, c.code)
+        # Nothing is written to the source.
+        self.assertEqual(Question.objects.count(), 1)
+        self.assertEqual(Choice.objects.count(), 6)
+
+    def test_clone_from_other_database(self):
+        question = Question.objects.using('other').create(question_text='a', pub_date=timezone.now())
+        Choice.objects.using('other').create(question=question, choice_text='x', votes=0)
+        q = Cloner().clone(question, source='other', target='default')
+        self.assertEqual(list(q.choice_set.values_list('choice_text', flat=True)), ['x'])
+        self.assertEqual(Question.objects.using('other').count(), 1)
+
+    @override_settings(DATABASE_ROUTERS=['tests.test_clone.ReplicaRouter'])
+    def test_clone_with_replica_router(self):
+        # The replica has the same rows as the primary database.
+        for using in ['default', 'other']:
+            question = Question.objects.db_manager(using).create(pk=1, question_text='a', pub_date=timezone.now())
+            Choice.objects.db_manager(using).create(pk=1, question=question, choice_text='x', votes=0)
+            BigChoice.objects.db_manager(using).create(pk=2, question=question, choice_text='big', votes=0)
+
+        cloner = Cloner()
+        for options in [{}, {'bulk': True}, {'streaming': True}]:
+            q = cloner.clone(question, **options)
+            self.assertEqual(q._state.db, 'default')
+            self.assertEqual(Choice.objects.using('default').filter(question=q).count(), 2)
+            self.assertEqual(BigChoice.objects.using('default').filter(question=q).count(), 1)
+        # Copies are only written to the primary database.
+        self.assertEqual(Question.objects.using('default').count(), 4)
+        self.assertEqual(Question.objects.using('other').count(), 1)
+        self.assertEqual(Choice.objects.using('other').count(), 2)
+
+
+class ReplicaRouter(object):
+    """
+    reads from the other database and writes to the default one
+    """
+
+    def db_for_read(self, model, **hints):
+        return 'other'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True